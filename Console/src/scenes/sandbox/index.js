@@ -62,7 +62,7 @@ const ScanPage = () => {
           },
         });
 
-      if (response.status === 200) {
+      if (response.status === 200 || response.status === 202) {
         const reportID = response.data.report_id;
         const searchEndpoint = `https://community.webamon.co.uk/report/${reportID}`;
         let searchResponse;
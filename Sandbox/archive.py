@@ -0,0 +1,87 @@
+import glob
+import gzip
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+# Report fields copied into an archive so a replay rebuilds the same report
+REPORT_FIELDS = ['report_id', 'submission_url', 'submission_utc', 'date', 'tag', 'source', 'feed', 'resolved_url',
+                 'page_title', 'dom', 'cookie', 'screenshot']
+
+
+class ReplayDriver:
+    """Stands in for the Chrome driver when rebuilding a report, answering ``Network.getResponseBody``
+    from the bodies recorded in an archive. Bodies archived truncated come back with the hashes
+    of the whole body, which the truncated text can no longer give."""
+
+    def __init__(self, archive):
+        self.bodies = archive['bodies']
+        self.body_index = archive['body_index']
+        self.base64 = set(archive.get('base64', []))
+        self.hashes = archive.get('hashes', {})
+
+    def execute_cdp_cmd(self, cmd, params):
+        sha256 = self.body_index.get(params['requestId'])
+        if sha256 is None or sha256 not in self.bodies:
+            return {}
+        response = {'body': self.bodies[sha256], 'base64Encoded': sha256 in self.base64}
+        if sha256 in self.hashes:
+            response['hashes'] = self.hashes[sha256]
+        return response
+
+    def get_log(self, log_type):
+        return []
+
+
+class ArchiveStore:
+    """Scan archives, one gzipped json per report holding what the browser produced for it.
+
+    The Network events from the performance log are kept as recorded and bodies are stored once
+    per sha256, so a report can be rebuilt from an archive without a browser or the original site.
+    Bodies over ``max_body_bytes`` are archived truncated, as they were stored, along with the
+    hashes of the whole body so a replay gives the resource the same sha256.
+    """
+
+    def __init__(self, path, level=6):
+        self.path = path
+        self.level = level
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def path_for(self, report_id):
+        return os.path.join(self.path, f'{report_id}.json.gz')
+
+    def write(self, report, log, bodies):
+        archive = {'version': VERSION, 'performance_log': log, 'bodies': {}, 'body_index': {}, 'base64': [], 'hashes': {}}
+        for field in REPORT_FIELDS:
+            if field in report:
+                archive[field] = report[field]
+        for sha256, resource in report.get('resource_master', {}).items():
+            archive['bodies'][sha256] = bodies.get(sha256)
+            archive['body_index'][resource['request_id']] = sha256
+            if resource.get('base64_encoded'):
+                archive['base64'].append(sha256)
+            if resource.get('truncated'):
+                archive['hashes'][sha256] = resource['hashes']
+        path = self.path_for(report['report_id'])
+        tmp = f'{path}.tmp'
+        with gzip.open(tmp, 'wt', compresslevel=self.level) as file:
+            json.dump(archive, file, separators=(',', ':'))
+        os.replace(tmp, path)
+        logger.debug(f"Archived {report['submission_url']} to {path}")
+        return path
+
+    @staticmethod
+    def read(path):
+        with gzip.open(path, 'rt') as file:
+            archive = json.load(file)
+        if archive.get('version') != VERSION:
+            raise ValueError(f"Unsupported archive version {archive.get('version')} in {path}")
+        return archive
+
+    def list(self):
+        return sorted(glob.glob(os.path.join(self.path, '*.json.gz')))
@@ -0,0 +1,309 @@
+import argparse
+import copy
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import statistics
+import sys
+import time
+import tracemalloc
+
+import hosts
+import pipeline
+from hashing import Hasher, digests, hash_types
+from archive import ArchiveStore, ReplayDriver, VERSION
+from metrics import StageTimer
+from report import Enrichment, Resources, Formatting, Technology
+from schema import normalize_report, normalize_request
+from network import NetworkCollector
+
+logger = logging.getLogger(__name__)
+
+# name: (requests, third party domains)
+PROFILES = {'small': (20, 3), 'typical': (150, 25), 'pathological': (3000, 300)}
+
+LIBRARIES = ['jquery-3.7.1.min.js', 'react.js', 'angular.js', 'vue.js', 'lodash.min.js', 'modernizr.js', 'bootstrap.min.js', 'app.js']
+MIME_TYPES = ['text/html', 'application/javascript', 'text/css', 'image/png', 'application/json', 'font/woff2']
+
+
+class NoGeoIP:
+
+    @staticmethod
+    def lookup_many(ips):
+        return {ip: (None, None) for ip in ips if ip}
+
+
+class OfflineEnrichment(Enrichment):
+    """Enrichment with GeoIP lookups only when the databases are present."""
+
+    def __init__(self):
+        if os.path.exists(r'geoIP/GeoLite2-ASN.mmdb'):
+            super().__init__()
+        else:
+            self.geoip = NoGeoIP()
+
+
+def event(method, params):
+    return {'message': json.dumps({'message': {'method': method, 'params': params}})}
+
+
+def synthetic_capture(requests, domains, seed=0):
+    """A scan archive shaped like the ones ``phuck`` writes, with ``requests`` requests spread over ``domains`` third parties."""
+    rnd = random.Random(seed)
+    root = 'phish-example.com'
+    hosts = [root] + [f'cdn{i}.thirdparty{i}.net' for i in range(domains)]
+    log = []
+    bodies = {}
+    body_index = {}
+    scripts = []
+    links = []
+    for i in range(requests):
+        request_id = f'{1000 + i}.1'
+        host = hosts[0] if i == 0 else rnd.choice(hosts)
+        mime = 'text/html' if i == 0 else rnd.choice(MIME_TYPES)
+        url = f'https://{host}/' if i == 0 else f'https://{host}/static/{i}/{rnd.choice(LIBRARIES)}'
+        headers = {'Accept': '*/*', 'User-Agent': 'Mozilla/5.0', 'Referer': f'https://{root}/'}
+        log.append(event('Network.requestWillBeSent', {'requestId': request_id, 'type': 'Script', 'request': {
+            'url': url, 'method': 'GET', 'headers': headers, 'initialPriority': 'High', 'referrerPolicy': 'strict-origin', 'isSameSite': False}}))
+        ip = f'10.{hosts.index(host) // 250}.{hosts.index(host) % 250}.{rnd.randint(1, 3)}'
+        response = {'url': url, 'status': rnd.choice([200, 200, 200, 304, 404]), 'statusText': 'OK', 'mimeType': mime, 'remoteIPAddress': ip,
+                    'remotePort': 443, 'encodedDataLength': 0, 'protocol': 'h2', 'securityState': 'secure', 'connectionId': i,
+                    'headers': {'server': rnd.choice(['nginx', 'cloudflare', 'Apache']), 'content-type': mime, 'cache-control': 'max-age=3600'},
+                    'timing': {'requestTime': 1.0, 'receiveHeadersEnd': 12.5},
+                    'securityDetails': {'protocol': 'TLS 1.3', 'keyExchange': '', 'keyExchangeGroup': 'X25519', 'cipher': 'AES_128_GCM',
+                                        'certificateId': 0, 'subjectName': host, 'sanList': [host], 'issuer': 'R3',
+                                        'validFrom': 1700000000, 'validTo': 1710000000, 'signedCertificateTimestampList': [],
+                                        'certificateTransparencyCompliance': 'compliant', 'serverSignatureAlgorithm': 2052, 'encryptedClientHello': False}}
+        log.append(event('Network.responseReceived', {'requestId': request_id, 'type': 'Script', 'response': response}))
+        body = ''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz;{}() \n') for _ in range(rnd.randint(200, 4000)))
+        log.append(event('Network.loadingFinished', {'requestId': request_id, 'encodedDataLength': len(body)}))
+        sha256 = hashlib.sha256(body.encode('utf-8')).hexdigest()
+        bodies[sha256] = body
+        body_index[request_id] = sha256
+        if mime == 'application/javascript':
+            scripts.append(f'<script src="{url}"></script>')
+        elif mime == 'text/css':
+            links.append(f'<link rel="stylesheet" href="{url}">')
+    dom = f"<html><head><title>Sign in</title>{''.join(links)}</head><body><form><input name='user'></form>{''.join(scripts)}</body></html>"
+    cookie = [{'name': 'session', 'value': 'x', 'domain': root, 'httpOnly': True, 'sameSite': 'Lax', 'secure': True}]
+    return {'version': VERSION, 'report_id': f'synthetic-{requests}', 'submission_url': f'https://{root}/', 'resolved_url': f'https://{root}/',
+            'dom': dom, 'cookie': cookie, 'performance_log': log, 'bodies': bodies, 'body_index': body_index}
+
+
+def load_fixtures(path):
+    """Recorded scans, the archives written by ``--archive`` in a scan."""
+    return {os.path.basename(file_path).split('.')[0]: ArchiveStore.read(file_path) for file_path in ArchiveStore(path).list()}
+
+
+def process(capture, config):
+    """Runs one capture through everything after the browser, returns the report with its ``timing``."""
+    report = {'request': {}, 'submission_url': capture['submission_url'], 'submission_utc': '', 'report_id': 'benchmark', 'errors': [],
+              'dom': capture['dom'], 'cookie': copy.deepcopy(capture['cookie']), 'resolved_url': capture['resolved_url'], 'timing': {}}
+    timer = StageTimer(report['timing'])
+    with timer.stage('network_log'):
+        Enrichment.response_data(capture['performance_log'], report)
+    with timer.stage('body_fetch'):
+        report['resource'], report['resource_master'], report['resource_stats'] = Resources.getResources(
+            report['request'], ReplayDriver(capture), report['report_id'], capture['submission_url'], config, config['hasher'])
+    report.pop('resource_master')
+    report = pipeline.process_capture(report)
+    with timer.stage('normalize'):
+        normalize_report(report)
+    return report
+
+
+def run(name, capture, config, iterations):
+    requests = sum(1 for entry in capture['performance_log'] if 'Network.requestWillBeSent' in entry['message'])
+    stages = {}
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        report = process(capture, config)
+        durations.append(time.perf_counter() - start)
+        if report['scan_status'] != 'success':
+            raise RuntimeError(f"{name} failed: {report['errors']}")
+        for stage, seconds in report['timing'].items():
+            stages.setdefault(stage, []).append(seconds)
+
+    tracemalloc.start()
+    process(capture, config)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    median = statistics.median(durations)
+    return {'requests': requests, 'domains': len(report['domain']), 'iterations': iterations,
+            'median_seconds': round(median, 4), 'pages_per_sec': round(1 / median, 2) if median else None,
+            'requests_per_sec': round(requests / median, 1) if median else None, 'peak_memory_mb': round(peak / 2 ** 20, 2),
+            'stages': {stage: round(statistics.median(values), 4) for stage, values in stages.items()}}
+
+
+def technology(urls):
+    """Per url cost of the technology matcher, cold and memoized, against one re.search per pattern."""
+    tech = Technology()
+    start = time.perf_counter()
+    for url in urls:
+        for pattern in tech.patterns:
+            if re.search(pattern['pattern'], url, re.IGNORECASE):
+                break
+    per_pattern = time.perf_counter() - start
+    start = time.perf_counter()
+    for url in urls:
+        tech.matcher._match(url)
+    cold = time.perf_counter() - start
+    for url in urls:
+        tech.matcher.match(url)
+    start = time.perf_counter()
+    for url in urls:
+        tech.matcher.match(url)
+    warm = time.perf_counter() - start
+    return {'urls': len(urls), 'median_seconds': round(cold, 4), 'per_pattern_us': round(per_pattern / len(urls) * 1e6, 2),
+            'cold_us': round(cold / len(urls) * 1e6, 2), 'memoized_us': round(warm / len(urls) * 1e6, 2)}
+
+
+def hashing(sizes_mb, names, hasher):
+    """Hashing throughput on MB-scale bodies, all digests in one pass against one pass per digest."""
+    results = {}
+    for size in sizes_mb:
+        data = random.Random(size).randbytes(size * 2 ** 20)
+        start = time.perf_counter()
+        digests(data, names)
+        single = time.perf_counter() - start
+        start = time.perf_counter()
+        for name in names:
+            hashlib.new(name, data).hexdigest()
+        separate = time.perf_counter() - start
+        start = time.perf_counter()
+        for future in [hasher.submit(data) for _ in range(hasher.workers)]:
+            future.result()
+        pooled = time.perf_counter() - start
+        results[f'{size}MB'] = {'single_pass_mb_s': round(size / single, 1), 'per_digest_mb_s': round(size / separate, 1),
+                                'pool_mb_s': round(size * hasher.workers / pooled, 1)}
+    return {'hash_types': names, 'median_seconds': None, 'sizes': results}
+
+
+def normalizer(capture, config, iterations):
+    """Records normalized by the collector as they are built against raw records put through
+    transform_headers + clean_data, both from the same performance log, time and allocations."""
+    log = capture['performance_log']
+    cookies = capture['cookie']
+
+    def responses(collector):
+        collector.feed(log)
+        return [record for record in collector.requests.values() if 'response' in record]
+
+    def legacy(report):
+        report['request'] = responses(NetworkCollector(normalize=False))
+        Formatting.clean_data(Formatting.transform_headers(report))
+
+    def schema(report):
+        report['request'] = [normalize_request(record) for record in responses(NetworkCollector())]
+        normalize_report(report)
+
+    results = {}
+    for name, func in (('legacy', legacy), ('schema', schema)):
+        copies = [{'cookie': copy.deepcopy(cookies)} for _ in range(iterations)]
+        durations = []
+        for report in copies:
+            start = time.perf_counter()
+            func(report)
+            durations.append(time.perf_counter() - start)
+        tracemalloc.start()
+        report = {'cookie': copy.deepcopy(cookies)}
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        func(report)
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = {'median_seconds': round(statistics.median(durations), 5), 'peak_kb': round(peak / 1024, 1),
+                         'blocks': sum(stat.count_diff for stat in after.compare_to(before, 'filename'))}
+    return {'requests': len(report['request']), 'median_seconds': results['schema']['median_seconds'], **results}
+
+
+def compare(results, baseline, tolerance):
+    """Names of the profiles more than ``tolerance`` slower than the baseline."""
+    regressions = []
+    for name, result in results.items():
+        if name in baseline and result['median_seconds'] and baseline[name]['median_seconds'] and \
+                result['median_seconds'] > baseline[name]['median_seconds'] * (1 + tolerance):
+            regressions.append(name)
+            logger.critical(f"{name} regressed: {result['median_seconds']}s against {baseline[name]['median_seconds']}s")
+    return regressions
+
+
+def get_config():
+    parser = argparse.ArgumentParser(description='Benchmark the report pipeline offline against recorded or synthetic captures.')
+    parser.add_argument('--profiles', type=str, help='Comma separated synthetic profiles to run', default=','.join(PROFILES))
+    parser.add_argument('--fixtures', type=str, help='Directory of scan archives to run as well', default='')
+    parser.add_argument('--iterations', type=int, help='Runs per fixture', default=5)
+    parser.add_argument('--output', type=str, help='Write the results as json to this file', default='')
+    parser.add_argument('--baseline', type=str, help='Results file to compare against', default='')
+    parser.add_argument('--tolerance', type=float, help='Allowed slowdown against the baseline before failing', default=0.2)
+    parser.add_argument('--technology', type=int, help='Urls to time the technology matcher on, 0 to skip', default=2000)
+    parser.add_argument('--hashing', type=str, help='Comma separated body sizes in MB to time hashing on, empty to skip', default='1,8,32')
+    parser.add_argument('--hash_types', type=str, help='Hash types computed for bodies', default='sha256,sha1,md5')
+    parser.add_argument('--hash_workers', type=int, help='Threads hashing large bodies', default=2)
+    parser.add_argument('--log_level', type=str, choices=["INFO", "DEBUG"], help='Set Logging Level INFO/DEBUG', default='INFO')
+    args = parser.parse_args()
+    config = vars(args)
+    config.update({'save_images': False, 'save_css': False, 'save_fonts': False, 'max_body_bytes': 0, 'max_scan_bytes': 0})
+    config['hash_types'] = hash_types(config['hash_types'])
+    config['hasher'] = Hasher(config)
+    return config
+
+
+def main():
+    config = get_config()
+    logging.basicConfig(level=config['log_level'])
+    pipeline.init_worker(config, enrichment=OfflineEnrichment)
+
+    fixtures = {name: synthetic_capture(*PROFILES[name]) for name in config['profiles'].split(',') if name}
+    if config['fixtures']:
+        fixtures.update(load_fixtures(config['fixtures']))
+
+    results = {}
+    for name, capture in fixtures.items():
+        results[name] = run(name, capture, config, config['iterations'])
+        result = results[name]
+        logger.info(f"{name} - {result['requests']} requests, {result['domains']} domains - {result['median_seconds']}s median - "
+                    f"{result['pages_per_sec']} pages/s - {result['requests_per_sec']} requests/s - peak {result['peak_memory_mb']}MB")
+        logger.info(f"{name} stages - " + ', '.join(f'{stage} {seconds}s' for stage, seconds in result['stages'].items()))
+
+    urls = []
+    if config['technology']:
+        urls = [json.loads(entry['message'])['message']['params']['request']['url'] for capture in fixtures.values()
+                for entry in capture['performance_log'] if 'Network.requestWillBeSent' in entry['message']]
+    if config['technology'] and urls:
+        results['technology'] = technology((urls * (config['technology'] // len(urls) + 1))[:config['technology']])
+        result = results['technology']
+        logger.info(f"technology - {result['urls']} urls - {result['per_pattern_us']}us per url with re.search per pattern - "
+                    f"{result['cold_us']}us matcher - {result['memoized_us']}us memoized")
+
+    for name, capture in fixtures.items():
+        result = results[f'{name}_normalizer'] = normalizer(capture, config, config['iterations'])
+        logger.info(f"{name} normalizer - {result['requests']} requests - schema {result['schema']['median_seconds']}s, "
+                    f"{result['schema']['blocks']} blocks, peak {result['schema']['peak_kb']}KB - transform_headers/clean_data "
+                    f"{result['legacy']['median_seconds']}s, {result['legacy']['blocks']} blocks, peak {result['legacy']['peak_kb']}KB")
+
+    if config['hashing']:
+        results['hashing'] = hashing([int(size) for size in config['hashing'].split(',')], config['hash_types'], config['hasher'])
+        for size, result in results['hashing']['sizes'].items():
+            logger.info(f"hashing {size} {','.join(config['hash_types'])} - {result['single_pass_mb_s']}MB/s single pass - "
+                        f"{result['per_digest_mb_s']}MB/s pass per digest - {result['pool_mb_s']}MB/s on {config['hash_workers']} workers")
+
+    logger.info(f"domain cache - {json.dumps(hosts.stats())}")
+
+    if config['output']:
+        with open(config['output'], 'w') as file:
+            json.dump(results, file, indent=2, default=str)
+    if config['baseline']:
+        with open(config['baseline']) as file:
+            if compare(results, json.load(file), config['tolerance']):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+import codecs
+import json
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Characters (or bytes, for spilled bodies) encoded at a time when streaming a body
+CHUNK = 256 * 1024
+
+
+class BodyStore:
+    """Response bodies of every report in flight, stored once per sha256.
+
+    Reports carry only the sha256 of their resources. Bodies up to ``spill_bytes`` are held in
+    memory, larger ones are written under ``path`` and read back memory mapped, so pages with
+    many large resources don't each hold their bodies on the heap. A body is reference
+    counted by the reports that fetched it and dropped with the last ``release``. Without a
+    ``path`` nothing spills. The spill directory is made on the first spill, and only by the
+    process that built the store.
+    """
+
+    def __init__(self, path='', spill_bytes=1024 * 1024):
+        self.spill_bytes = spill_bytes
+        self.root = path
+        self.path = None
+        self._pid = os.getpid()
+        self._memory = {}
+        self._files = {}
+        self._refs = {}
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.shared = 0
+        self.spilled = 0
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+
+    def _spill_dir(self):
+        with self._lock:
+            if self.path is None:
+                os.makedirs(self.root, exist_ok=True)
+                # Per engine run, the sha256 file names would otherwise collide between engines sharing the directory
+                self.path = tempfile.mkdtemp(prefix='bodies-', dir=self.root)
+            return self.path
+
+    def _spill(self, body):
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', errors='surrogatepass', dir=self._spill_dir(), delete=False) as file:
+            file.write(body)
+        return file.name
+
+    def put(self, sha256, body):
+        """Stores ``body`` under ``sha256``, or takes another reference when it is already stored."""
+        with self._lock:
+            if sha256 in self._refs:
+                self._refs[sha256] += 1
+                self.shared += 1
+                return
+        spilled = None
+        if self.root and len(body) > self.spill_bytes and os.getpid() == self._pid:
+            spilled = self._spill(body)
+        with self._lock:
+            if sha256 in self._refs:
+                # Another report stored it while this one was writing
+                self._refs[sha256] += 1
+                self.shared += 1
+            elif spilled:
+                size = os.path.getsize(spilled)
+                self._files[sha256] = (spilled, size)
+                self._refs[sha256] = 1
+                self.stored += 1
+                self.spilled += 1
+                self.disk_bytes += size
+                spilled = None
+            else:
+                self._memory[sha256] = body
+                self._refs[sha256] = 1
+                self.stored += 1
+                self.memory_bytes += len(body)
+        if spilled:
+            os.remove(spilled)
+
+    def __contains__(self, sha256):
+        with self._lock:
+            return sha256 in self._refs
+
+    def _file(self, sha256):
+        with self._lock:
+            if sha256 in self._memory:
+                return self._memory[sha256], None
+            path, size = self._files[sha256]
+        return None, (open(path, 'rb'), size)
+
+    def get(self, sha256):
+        """The body stored under ``sha256``, KeyError when there is none."""
+        body, spilled = self._file(sha256)
+        if spilled is None:
+            return body
+        file, size = spilled
+        with file:
+            if not size:
+                return ''
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                return view[:].decode('utf-8', errors='surrogatepass')
+
+    def json_chunks(self, sha256):
+        """The body as a json string literal, yielded as utf-8 bytes a chunk at a time so it is
+        never encoded whole."""
+        body, spilled = self._file(sha256)
+        yield b'"'
+        if spilled is None:
+            for start in range(0, len(body), CHUNK):
+                yield json.dumps(body[start:start + CHUNK])[1:-1].encode('utf-8')
+        else:
+            file, size = spilled
+            with file:
+                if size:
+                    decoder = codecs.getincrementaldecoder('utf-8')(errors='surrogatepass')
+                    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                        for start in range(0, size, CHUNK):
+                            text = decoder.decode(view[start:start + CHUNK], final=start + CHUNK >= size)
+                            yield json.dumps(text)[1:-1].encode('utf-8')
+        yield b'"'
+
+    def release(self, sha256s):
+        """Drops a reference to each body, bodies nothing refers to any more are freed."""
+        remove = []
+        with self._lock:
+            for sha256 in sha256s:
+                refs = self._refs.get(sha256)
+                if refs is None:
+                    continue
+                if refs > 1:
+                    self._refs[sha256] = refs - 1
+                    continue
+                del self._refs[sha256]
+                if sha256 in self._memory:
+                    self.memory_bytes -= len(self._memory.pop(sha256))
+                else:
+                    path, size = self._files.pop(sha256)
+                    self.disk_bytes -= size
+                    remove.append(path)
+        for path in remove:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.debug(f'Failed to remove spilled body {path} - {e}')
+
+    def close(self):
+        if self.path:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            return {'bodies': len(self._refs), 'stored': self.stored, 'shared': self.shared, 'spilled': self.spilled,
+                    'memory_bytes': self.memory_bytes, 'disk_bytes': self.disk_bytes}
@@ -0,0 +1,182 @@
+import logging
+import queue
+import threading
+import time
+
+from selenium import webdriver
+
+from network import NetworkCollector, origin
+
+logger = logging.getLogger(__name__)
+
+CRASH_ERRORS = ['invalid session id', 'chrome not reachable', 'tab crashed', 'session deleted', 'disconnected']
+
+
+class BrowserSession:
+    def __init__(self, driver, launch_time):
+        self.driver = driver
+        self.launch_time = launch_time
+        self.scans = 0
+        self.fresh = True
+        self.broken = False
+
+    def check(self, error):
+        if any(crash in str(error) for crash in CRASH_ERRORS):
+            logger.warning(f'Chrome session crashed, recycling: {error}')
+            self.broken = True
+
+
+class BrowserPool:
+    """Keeps warm Chrome sessions around so a scan doesn't pay for a browser launch.
+
+    Sessions are reset between scans and recycled after ``browser_recycle`` scans,
+    or straight away when they crash. A reset clears cookies, the cache and the storage of
+    every origin the last scan sent a request to, so redirect hops and third-party frames
+    leave nothing behind for the next scan.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.size = int(config['threads'])
+        self.max_scans = int(config['browser_recycle'])
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._open = 0
+        self.launches = 0
+        self.recycled = 0
+        self.launch_seconds = 0.0
+
+    def options(self):
+        options = webdriver.ChromeOptions()
+        options.binary_location = '/app/chrome/chrome'
+        options.add_argument("--headless")
+        options.add_argument('--no-sandbox')
+        options.add_argument("--disable-gpu")
+        options.add_argument('--ignore-ssl-errors')
+        options.add_argument('--ignore-certificate-errors')
+        options.add_argument("--window-size=1280x1696")
+        options.add_argument("--single-process")
+        options.add_argument("--disable-dev-shm-usage")
+        options.add_argument("--disable-dev-tools")
+        options.add_argument("--no-zygote")
+        options.add_argument(f"user-agent={self.config['user_agent']}")
+        options.set_capability('goog:loggingPrefs', {'browser': 'ALL', 'performance': 'ALL'})
+        # Only Network events go to the performance log, no Page/Timeline noise
+        options.add_experimental_option('perfLoggingPrefs', {'enableNetwork': True, 'enablePage': False})
+        return options
+
+    def launch(self):
+        start = time.monotonic()
+        service = webdriver.ChromeService("/app/chromedriver")
+        driver = webdriver.Chrome(options=self.options(), service=service)
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.set_page_load_timeout(self.config['scan_timeout'])
+        launch_time = time.monotonic() - start
+        with self._lock:
+            self.launches += 1
+            self.launch_seconds += launch_time
+        logger.debug(f'Launched Chrome session in {launch_time:.2f}s')
+        return BrowserSession(driver, launch_time)
+
+    def warm(self, size=None):
+        if size:
+            self.size = int(size)
+        with self._lock:
+            missing = self.size - self._open
+            self._open += max(missing, 0)
+        threads = [threading.Thread(target=self._warm_one) for _ in range(max(missing, 0))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        logger.info(f'Browser pool warmed - {self._idle.qsize()} sessions ready')
+
+    def _warm_one(self):
+        try:
+            self._idle.put(self.launch())
+        except Exception as e:
+            logger.critical(f'Failed to launch Chrome session: {e}')
+            with self._lock:
+                self._open -= 1
+
+    def acquire(self):
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self._lock:
+                can_launch = self._open < self.size
+                if can_launch:
+                    self._open += 1
+            if can_launch:
+                try:
+                    return self.launch()
+                except Exception:
+                    with self._lock:
+                        self._open -= 1
+                    raise
+            try:
+                return self._idle.get(timeout=1)
+            except queue.Empty:
+                continue
+
+    def release(self, session, origins=()):
+        """Returns a session to the pool, ``origins`` are those the scan's collector saw."""
+        session.scans += 1
+        session.fresh = False
+        if not session.broken and session.scans < self.max_scans:
+            try:
+                self.reset(session.driver, origins)
+                self._idle.put(session)
+                return
+            except Exception as e:
+                logger.warning(f'Chrome session failed to reset, recycling: {e}')
+        with self._lock:
+            self.recycled += 1
+        self.discard(session)
+
+    def discard(self, session):
+        with self._lock:
+            self._open -= 1
+        try:
+            session.driver.quit()
+        except Exception as e:
+            logger.debug(f'Error quitting Chrome session: {e}')
+
+    @staticmethod
+    def reset(driver, origins=()):
+        current = driver.current_window_handle
+        for target in driver.execute_cdp_cmd('Target.getTargets', {})['targetInfos']:
+            if target['type'] == 'page' and target['targetId'] != current:
+                driver.execute_cdp_cmd('Target.closeTarget', {'targetId': target['targetId']})
+        origins = set(origins)
+        origins.add(origin(driver.current_url))
+        driver.get('about:blank')
+        # Events the scan never drained (it failed, or requests came after the last drain) name origins too
+        leftover = NetworkCollector()
+        leftover.drain(driver)
+        origins |= leftover.origins()
+        origins.discard(None)
+        for name in origins:
+            # 'all' covers localStorage, IndexedDB, Cache Storage and service worker registrations
+            driver.execute_cdp_cmd('Storage.clearDataForOrigin', {'origin': name, 'storageTypes': 'all'})
+        driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+        driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+        # Disabling the Network domain drops buffered response bodies from the last scan
+        driver.execute_cdp_cmd('Network.disable', {})
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.get_log('performance')
+
+    def stats(self):
+        with self._lock:
+            return {'size': self.size, 'open': self._open, 'idle': self._idle.qsize(), 'launches': self.launches,
+                    'recycled': self.recycled, 'avg_launch_time': round(self.launch_seconds / self.launches, 3) if self.launches else 0.0}
+
+    def close(self):
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(session)
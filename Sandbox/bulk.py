@@ -0,0 +1,199 @@
+import json
+import logging
+import threading
+import time
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Item errors OpenSearch answers when its write queues are full, worth sending again
+REJECTED = ('es_rejected_execution_exception', 'rejected_execution_exception', 'circuit_breaking_exception')
+
+
+class BulkWriter:
+    """Buffers bulk actions from every thread and sends them through ``_bulk`` from a background thread.
+
+    A batch is sent once ``bulk_flush_bytes`` are buffered or ``bulk_flush_interval`` seconds
+    after the oldest buffered action. Items OpenSearch rejects (429, full write queues) and
+    batches that fail outright are sent again with backoff up to ``bulk_retries`` times, any
+    other item error is logged and counted. Items waiting out their backoff are held aside
+    while the writer keeps sending everything else. ``add`` blocks while ``bulk_max_pending_bytes``
+    are waiting to be written, so a slow cluster slows the persist threads down instead of
+    filling memory.
+    """
+
+    def __init__(self, client, config):
+        self.client = client
+        self.flush_bytes = config.get('bulk_flush_bytes', 5 * 1024 * 1024)
+        self.flush_interval = config.get('bulk_flush_interval', 1.0)
+        self.max_pending_bytes = config.get('bulk_max_pending_bytes', 50 * 1024 * 1024)
+        self.retries = config.get('bulk_retries', 3)
+        self.backoff = config.get('bulk_retry_backoff', 1.0)
+        self._cond = threading.Condition()
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._oldest = None
+        # Items waiting out a retry backoff, as (due, data, index, attempt)
+        self._delayed = []
+        # Threads waiting in add for room, the buffer is sent without waiting out the interval
+        self._blocked = 0
+        # Bytes added and not yet written or given up on, buffered or in flight
+        self.pending_bytes = 0
+        self.indexed = 0
+        self.failed = 0
+        self.retried = 0
+        self.batches = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='bulk-writer', daemon=True)
+        self._thread.start()
+
+    def add(self, action, index, source, _id=None, **params):
+        """Queues one bulk action (``index``, ``create``, ``update``), returns once it is buffered.
+        ``params`` go in the action line, e.g. ``retry_on_conflict``."""
+        meta = {"_index": index}
+        if _id:
+            meta["_id"] = _id
+        meta.update(params)
+        data = (json.dumps({action: meta}) + '\n' + json.dumps(source) + '\n').encode('utf-8')
+        with self._cond:
+            while self.pending_bytes and self.pending_bytes + len(data) > self.max_pending_bytes and not self._closed:
+                self._blocked += 1
+                self._cond.notify_all()
+                self._cond.wait()
+                self._blocked -= 1
+            if self._closed:
+                raise RuntimeError(f'Bulk writer is closed, {action} on {index} not written')
+            self.pending_bytes += len(data)
+            self._append(data, index, 0)
+
+    def index(self, index, source, _id=None):
+        self.add('index', index, source, _id)
+
+    def update(self, index, _id, body, retry_on_conflict=3):
+        self.add('update', index, body, _id, retry_on_conflict=retry_on_conflict)
+
+    def _append(self, data, index, attempt):
+        self._buffer.append((data, index, attempt))
+        self._buffered_bytes += len(data)
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        self._cond.notify_all()
+
+    def _requeue(self, now):
+        if not any(due <= now for due, _, _, _ in self._delayed):
+            return
+        delayed, self._delayed = self._delayed, []
+        for due, data, index, attempt in delayed:
+            if due <= now:
+                self._append(data, index, attempt)
+            else:
+                self._delayed.append((due, data, index, attempt))
+
+    def _take(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._requeue(now)
+                timeout = None
+                if self._buffer:
+                    waited = now - self._oldest
+                    if self._closed or self._blocked or self._buffered_bytes >= self.flush_bytes or waited >= self.flush_interval:
+                        batch, self._buffer, self._buffered_bytes, self._oldest = self._buffer, [], 0, None
+                        return batch
+                    timeout = self.flush_interval - waited
+                elif self._closed and not self._delayed:
+                    return None
+                if self._delayed:
+                    due = min(due for due, _, _, _ in self._delayed) - now
+                    timeout = due if timeout is None else min(timeout, due)
+                self._cond.wait(timeout)
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+            try:
+                self._send(batch)
+            except Exception as e:
+                logger.critical(f'Bulk writer failed on a batch of {len(batch)} - {e}')
+                self._done(batch, failed=True)
+
+    def _send(self, batch):
+        start = time.monotonic()
+        try:
+            response = self.client.request('POST', '_bulk', b''.join(data for data, _, _ in batch), content_type='application/x-ndjson')
+            status = response.status_code
+        except Exception as e:
+            logger.warning(f'Bulk request of {len(batch)} failed - {e}')
+            response, status = None, 0
+        metrics.observe('bulk_flush_seconds', time.monotonic() - start)
+        with self._cond:
+            self.batches += 1
+        if status != 200:
+            if response is not None:
+                logger.warning(f'Bulk request of {len(batch)} answered {status} - {response.text[:500]}')
+            self._retry(batch)
+            return
+        result = response.json()
+        if not result.get('errors'):
+            self._done(batch)
+            return
+        retry, done, failed = [], [], []
+        for entry, item in zip(batch, result['items']):
+            outcome = next(iter(item.values()))
+            error = outcome.get('error')
+            if not error:
+                done.append(entry)
+            elif outcome.get('status') == 429 or error.get('type') in REJECTED:
+                retry.append(entry)
+            else:
+                logger.critical(f"Bulk item failed on {entry[1]}/{outcome.get('_id', '')} - {error.get('type')}: {error.get('reason')}")
+                failed.append(entry)
+        self._done(done)
+        self._done(failed, failed=True)
+        self._retry(retry)
+
+    def _retry(self, entries):
+        if not entries:
+            return
+        retry = [entry for entry in entries if entry[2] < self.retries]
+        self._done([entry for entry in entries if entry[2] >= self.retries], failed=True)
+        if not retry:
+            return
+        attempt = max(entry[2] for entry in retry) + 1
+        with self._cond:
+            self.retried += len(retry)
+        for _, index, _ in retry:
+            metrics.inc('bulk_items', index=index, status='retried')
+        delay = self.backoff * 2 ** (attempt - 1)
+        logger.info(f'Retrying {len(retry)} bulk items in {delay:.1f}s (attempt {attempt + 1}/{self.retries + 1})')
+        due = time.monotonic() + delay
+        with self._cond:
+            self._delayed.extend((due, data, index, previous + 1) for data, index, previous in retry)
+            self._cond.notify_all()
+
+    def _done(self, entries, failed=False):
+        if not entries:
+            return
+        for _, index, _ in entries:
+            metrics.inc('bulk_items', index=index, status='failed' if failed else 'indexed')
+        with self._cond:
+            if failed:
+                self.failed += len(entries)
+            else:
+                self.indexed += len(entries)
+            self.pending_bytes -= sum(len(data) for data, _, _ in entries)
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def stats(self):
+        with self._cond:
+            return {'pending_bytes': self.pending_bytes, 'buffered': len(self._buffer), 'delayed': len(self._delayed), 'indexed': self.indexed, 'failed': self.failed,
+                    'retried': self.retried, 'batches': self.batches}
@@ -19,11 +19,11 @@ class Democracy:
             return False
         return response.json()['resources']
 
-    def save_new_resources(self, resource_master, new_resources):
+    def save_new_resources(self, resource_master, new_resources, bodies):
         date = datetime.utcnow().strftime("%Y-%m-%d")
         for sha256 in new_resources:
             mime = resource_master[sha256]['mime_type']
-            raw = resource_master[sha256]['raw_data']
+            raw = bodies.get(sha256)
             data = {"date": date, "resource": raw, "mime_type": mime, 'sha256': sha256}
             if ('css' or 'image') not in mime:
                 response = requests.post(f'{community_url}/save-resource', headers=self.headers, json=data)
@@ -45,7 +45,7 @@ class Democracy:
             return False
         return response.json()
 
-    def save(self, report):
+    def save(self, report, bodies):
         resources = report.pop('resource_master', False)
         resource_meta = report['resource']
         if resources and resource_meta:
@@ -53,7 +53,7 @@ class Democracy:
             if check_exists:
                 new = [resource['sha256'] for resource in check_exists if not resource['exists']]
                 print(new)
-                save_new = self.save_new_resources(resources, new)
+                save_new = self.save_new_resources(resources, new, bodies)
 
         success = self.save_report(report)
         if success:
@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import dns.exception
+import dns.resolver
+
+from metrics import metrics
+
+RECORD_TYPES = ['A', 'AAAA', 'MX', 'NS', 'TXT', 'CNAME', 'SOA', 'PTR']
+
+# Cached in place of the answers for a domain that does not exist
+NXDOMAIN = object()
+
+
+class DNSCache:
+    """DNS records for report domains, shared by every persistence thread.
+
+    Record types are queried concurrently on a thread pool. Answers are cached for their TTL
+    (capped at ``dns_max_ttl``) and empty answers/NXDOMAIN for ``dns_negative_ttl``. Lookup
+    errors are returned but not cached. ``dns`` picks the domains looked up: ALL, MAIN (the
+    scanned site only) or NONE.
+    """
+
+    def __init__(self, config):
+        self.mode = config['dns']
+        self.timeout = float(config['dns_timeout'])
+        self.max_ttl = int(config['dns_max_ttl'])
+        self.negative_ttl = int(config['dns_negative_ttl'])
+        self.max_entries = int(config['dns_cache_size'])
+        self.resolver = dns.resolver.Resolver()
+        self.executor = ThreadPoolExecutor(max_workers=int(config['dns_workers']), thread_name_prefix='dns')
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.query_seconds = 0.0
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def _put(self, key, value, ttl):
+        with self._lock:
+            self._cache[key] = (time.monotonic() + ttl, value)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def query(self, domain, record_type):
+        """Answers for one record type as a list of strings, NXDOMAIN, or raises on lookup errors."""
+        key = (domain, record_type)
+        cached = self._get(key)
+        if cached is not None:
+            metrics.inc('dns_queries', result='hit')
+            return cached
+        start = time.monotonic()
+        try:
+            answers = self.resolver.resolve(domain, record_type, lifetime=self.timeout)
+            value, ttl = [str(answer) for answer in answers], min(answers.rrset.ttl, self.max_ttl)
+        except dns.resolver.NXDOMAIN:
+            value, ttl = NXDOMAIN, self.negative_ttl
+        except dns.resolver.NoAnswer:
+            value, ttl = [], self.negative_ttl
+        except dns.exception.DNSException:
+            with self._lock:
+                self.errors += 1
+            metrics.inc('dns_queries', result='error')
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self.query_seconds += elapsed
+            metrics.observe('dns_lookup_seconds', elapsed)
+        metrics.inc('dns_queries', result='miss')
+        self._put(key, value, ttl)
+        return value
+
+    def _submit(self, domain):
+        return {record_type: self.executor.submit(self.query, domain, record_type) for record_type in RECORD_TYPES}
+
+    @staticmethod
+    def _collect(futures):
+        dns_info = {}
+        for record_type, future in futures.items():
+            try:
+                answers = future.result()
+            except Exception as e:
+                dns_info[record_type] = f"Error retrieving {record_type} records: {e}"
+                continue
+            if answers is NXDOMAIN:
+                return {"error": "Domain does not exist"}
+            dns_info[record_type.lower()] = list(answers)
+        return dns_info
+
+    def lookup(self, domain):
+        """Every record type for ``domain`` in the layout get_dns_info used."""
+        return self._collect(self._submit(domain))
+
+    def enrich(self, report):
+        """Adds ``dns`` to the report's domain documents picked by the ``dns`` setting, all queries go out at once."""
+        if self.mode == 'NONE':
+            return report
+        pending = [(domain, self._submit(domain['name'])) for domain in report.get('domain', [])
+                   if domain.get('name') and (self.mode == 'ALL' or domain['root'])]
+        for domain, futures in pending:
+            domain['dns'] = self._collect(futures)
+        return report
+
+    def stats(self):
+        with self._lock:
+            queries = self.hits + self.misses
+            return {'entries': len(self._cache), 'hits': self.hits, 'misses': self.misses, 'errors': self.errors,
+                    'hit_rate': round(self.hits / queries, 3) if queries else 0.0,
+                    'avg_latency': round(self.query_seconds / self.misses, 3) if self.misses else 0.0}
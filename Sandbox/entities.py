@@ -0,0 +1,156 @@
+import logging
+import threading
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Merges a new domain/server observation into the stored document, run by OpenSearch in a scripted
+# upsert. The observation replaces the document except first_seen_utc, which is kept, the
+# params.union lists and dns answer lists, which are merged, and resource, which keeps the new
+# resources first and then previous ones up to params.max_resources.
+MERGE_SCRIPT = """
+def old = ctx._source;
+def doc = params.doc;
+if (old.first_seen_utc != null) { doc.first_seen_utc = old.first_seen_utc; }
+for (field in params.union) {
+  def previous = old.get(field);
+  if (previous instanceof List) {
+    def merged = doc.get(field) instanceof List ? new ArrayList(doc.get(field)) : new ArrayList();
+    for (value in previous) { if (!merged.contains(value)) { merged.add(value); } }
+    doc.put(field, merged);
+  }
+}
+if (old.resource instanceof List) {
+  def resources = doc.resource instanceof List ? new ArrayList(doc.resource) : new ArrayList();
+  def hashes = new HashSet();
+  for (resource in resources) { hashes.add(resource.sha256); }
+  for (resource in old.resource) {
+    if (resources.size() >= params.max_resources) { break; }
+    if (hashes.add(resource.sha256)) { resources.add(resource); }
+  }
+  doc.resource = resources;
+}
+if (doc.dns instanceof Map && old.dns instanceof Map) {
+  for (entry in doc.dns.entrySet()) {
+    def previous = old.dns.get(entry.getKey());
+    if (previous instanceof List && entry.getValue() instanceof List) {
+      def merged = new ArrayList(entry.getValue());
+      for (value in previous) { if (!merged.contains(value)) { merged.add(value); } }
+      entry.setValue(merged);
+    }
+  }
+}
+ctx._source = doc;
+"""
+
+
+def merge(previous, record, union, max_resources):
+    """``record`` merged into an earlier observation of the same entity, the rules of MERGE_SCRIPT."""
+    merged = dict(record)
+    if previous.get('first_seen_utc') is not None:
+        merged['first_seen_utc'] = previous['first_seen_utc']
+    for field in union:
+        if isinstance(previous.get(field), list):
+            values = list(record.get(field) or [])
+            values.extend(value for value in previous[field] if value not in values)
+            merged[field] = values
+    if isinstance(previous.get('resource'), list):
+        resources = list(record.get('resource') or [])
+        hashes = {resource['sha256'] for resource in resources}
+        for resource in previous['resource']:
+            if len(resources) >= max_resources:
+                break
+            if resource['sha256'] not in hashes:
+                hashes.add(resource['sha256'])
+                resources.append(resource)
+        merged['resource'] = resources
+    if isinstance(record.get('dns'), dict) and isinstance(previous.get('dns'), dict):
+        merged['dns'] = dict(record['dns'])
+        for name, values in record['dns'].items():
+            earlier = previous['dns'].get(name)
+            if isinstance(earlier, list) and isinstance(values, list):
+                merged['dns'][name] = values + [value for value in earlier if value not in values]
+    return merged
+
+
+def upsert(record, union, max_resources):
+    """Bulk update body merging ``record`` into the stored document, or creating it."""
+    record['resource'] = record.get('resource', [])[:max_resources]
+    return {"script": {"source": MERGE_SCRIPT, "lang": "painless", "params": {"doc": record, "union": union, "max_resources": max_resources}},
+            "upsert": record}
+
+
+class EntityCache:
+    """Coalesces domain and server observations in memory before they are written.
+
+    The same third parties (analytics, CDNs, fonts) turn up in nearly every scan. Observations
+    of an entity are merged into one pending document, with the rules the stored document is
+    merged by, and every ``entity_flush_interval`` seconds one upsert per entity goes to the
+    bulk writer. Writes then scale with distinct entities rather than scans. Up to
+    ``entity_cache_size`` entities are held, past that everything pending is written early. An
+    interval of 0 writes every observation straight through.
+    """
+
+    def __init__(self, writer, config):
+        self.writer = writer
+        self.interval = config.get('entity_flush_interval', 30)
+        self.max_entities = config.get('entity_cache_size', 10000)
+        self.max_resources = config.get('entity_max_resources', 1000)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.observations = 0
+        self.writes = 0
+        self._thread = None
+        if self.interval:
+            self._thread = threading.Thread(target=self._run, name='entity-cache', daemon=True)
+            self._thread.start()
+
+    def add(self, index, _id, record, union):
+        metrics.inc('entity_observations', index=index)
+        if not self.interval:
+            with self._lock:
+                self.observations += 1
+            self._write(index, _id, record, union)
+            return
+        with self._lock:
+            self.observations += 1
+            key = (index, _id)
+            previous = self._pending.get(key)
+            self._pending[key] = (merge(previous[0], record, union, self.max_resources) if previous else record, union)
+            full = len(self._pending) >= self.max_entities
+        if full:
+            self.flush()
+
+    def _write(self, index, _id, record, union):
+        self.writer.update(index, _id, upsert(record, union, self.max_resources))
+        metrics.inc('entity_writes', index=index)
+        with self._lock:
+            self.writes += 1
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for (index, _id), (record, union) in pending.items():
+            try:
+                self._write(index, _id, record, union)
+            except Exception as e:
+                logger.critical(f'Failed to queue {index}/{_id} - {e}')
+        if pending:
+            logger.debug(f'Wrote {len(pending)} coalesced entities')
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {'pending': len(self._pending), 'observations': self.observations, 'writes': self.writes,
+                    'coalesced': round(1 - self.writes / self.observations, 3) if self.observations else 0.0}
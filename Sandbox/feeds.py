@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+FEEDS = {}
+
+
+def register(feed):
+    FEEDS[feed.name] = feed
+    return feed
+
+
+class Feed:
+    """A url source polled with conditional requests, only urls missing from the last snapshot are returned.
+
+    Subclasses set ``name``/``url`` and can override ``parse``. ``poll`` returns the new urls,
+    ``commit`` stores the polled feed as the snapshot once those urls are queued. Urls handed
+    to ``queue`` stay in the queued set, saved with the snapshot, until ``done`` is called for
+    them, so a restart ``resume``s the urls it never finished instead of losing them.
+    """
+
+    name = ''
+    url = ''
+
+    def __init__(self, config):
+        self.config = config
+        os.makedirs(config['feed_state_dir'], exist_ok=True)
+        self.snapshot_path = os.path.join(config['feed_state_dir'], f'{self.name}.snapshot')
+        self.meta_path = os.path.join(config['feed_state_dir'], f'{self.name}.meta.json')
+        self.queued_path = os.path.join(config['feed_state_dir'], f'{self.name}.queued')
+        self.meta = self._load_meta()
+        self.snapshot = self._load_urls(self.snapshot_path)
+        self.queued = self._load_urls(self.queued_path)
+        self._lock = threading.Lock()
+        self._pending = None
+        self._pending_meta = {}
+        self.stats = {'polls': 0, 'not_modified': 0, 'errors': 0, 'fetched': 0, 'delta': 0, 'total_delta': 0,
+                      'fetch_time': 0.0, 'latency': None}
+
+    def _load_meta(self):
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as file:
+                return json.load(file)
+        return {}
+
+    @staticmethod
+    def _load_urls(path):
+        if os.path.exists(path):
+            with open(path) as file:
+                return set(file.read().splitlines())
+        return set()
+
+    @staticmethod
+    def _save_urls(path, urls):
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as file:
+            file.write('\n'.join(urls))
+        os.replace(tmp, path)
+
+    def parse(self, text):
+        return [line.strip() for line in text.splitlines() if line.strip()]
+
+    def fetch(self):
+        """Returns the feed urls, or None when unchanged since the last poll or on error."""
+        headers = {}
+        if self.meta.get('etag'):
+            headers['If-None-Match'] = self.meta['etag']
+        if self.meta.get('last_modified'):
+            headers['If-Modified-Since'] = self.meta['last_modified']
+        start = time.monotonic()
+        response = requests.get(self.url, headers=headers, timeout=60)
+        self.stats['fetch_time'] = round(time.monotonic() - start, 3)
+        if response.status_code == 304:
+            self.stats['not_modified'] += 1
+            return None
+        if response.status_code != 200:
+            logger.critical(f'Failed to retrieve {self.name} feed: {response.status_code}')
+            self.stats['errors'] += 1
+            return None
+        self._pending_meta = {'etag': response.headers.get('ETag', ''), 'last_modified': response.headers.get('Last-Modified', '')}
+        if self._pending_meta['last_modified']:
+            published = parsedate_to_datetime(self._pending_meta['last_modified'])
+            self.stats['latency'] = round((datetime.now(timezone.utc) - published).total_seconds(), 1)
+        return self.parse(response.text)
+
+    def poll(self):
+        self.stats['polls'] += 1
+        try:
+            urls = self.fetch()
+        except requests.RequestException as e:
+            logger.critical(f'Failed to retrieve {self.name} feed: {e}')
+            self.stats['errors'] += 1
+            return []
+        if urls is None:
+            self.stats['delta'] = 0
+            return []
+        self._pending = urls
+        delta = [url for url in dict.fromkeys(urls) if url not in self.snapshot]
+        self.stats['fetched'] = len(urls)
+        self.stats['delta'] = len(delta)
+        self.stats['total_delta'] += len(delta)
+        logger.info(f"{self.name} feed - {len(urls)} urls, {len(delta)} new - published {self.stats['latency']}s ago")
+        return delta
+
+    def queue(self, urls):
+        with self._lock:
+            self.queued.update(urls)
+
+    def done(self, url):
+        with self._lock:
+            self.queued.discard(url)
+
+    def resume(self):
+        """The urls queued by a previous run and never finished, they leave the queued set until queued again."""
+        with self._lock:
+            urls, self.queued = list(self.queued), set()
+        if urls:
+            logger.info(f'{self.name} feed - resuming {len(urls)} unfinished urls')
+        return urls
+
+    def commit(self):
+        with self._lock:
+            queued = list(self.queued)
+        self._save_urls(self.queued_path, queued)
+        if self._pending is None:
+            return
+        self.snapshot = set(self._pending)
+        self._save_urls(self.snapshot_path, self._pending)
+        self.meta = self._pending_meta
+        with open(self.meta_path, 'w') as file:
+            json.dump(self.meta, file)
+        self._pending = None
+
+
+@register
+class OpenPhish(Feed):
+    name = 'openphish'
+    url = 'https://www.openphish.com/feed.txt'
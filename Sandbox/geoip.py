@@ -0,0 +1,95 @@
+import ipaddress
+import threading
+from collections import OrderedDict
+
+import geoip2.database
+import geoip2.errors
+from maxminddb import MODE_MMAP
+
+
+class GeoIP:
+    """Country and ASN lookups cached by network prefix.
+
+    The databases are memory mapped, so enrichment processes share one page cache copy. A
+    lookup caches its answer under the most specific network both databases returned for the
+    IP, any other IP in that network is answered from the cache. The cache is LRU bounded at
+    ``cache_size`` networks and shared by threads.
+    """
+
+    def __init__(self, asn_path, country_path, cache_size=16384):
+        self.ip_asn = geoip2.database.Reader(asn_path, mode=MODE_MMAP)
+        self.ip_country = geoip2.database.Reader(country_path, mode=MODE_MMAP)
+        self.cache_size = cache_size
+        self._networks = OrderedDict()
+        # Prefix lengths cached so far per IP version, longest first
+        self._prefixes = {4: [], 6: []}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, address):
+        with self._lock:
+            for prefix in self._prefixes[address.version]:
+                network = ipaddress.ip_network((address, prefix), strict=False)
+                if network in self._networks:
+                    self._networks.move_to_end(network)
+                    self.hits += 1
+                    return self._networks[network]
+            self.misses += 1
+        return None
+
+    def _store(self, network, result):
+        with self._lock:
+            self._networks[network] = result
+            self._networks.move_to_end(network)
+            prefixes = self._prefixes[network.version]
+            if network.prefixlen not in prefixes:
+                prefixes.append(network.prefixlen)
+                prefixes.sort(reverse=True)
+            while len(self._networks) > self.cache_size:
+                self._networks.popitem(last=False)
+
+    def _country(self, ip):
+        try:
+            result = self.ip_country.country(ip)
+        except geoip2.errors.AddressNotFoundError as e:
+            return None, e.network
+        return {"name": result.country.name, "iso": result.country.iso_code}, result.traits.network
+
+    def _asn(self, ip):
+        try:
+            result = self.ip_asn.asn(ip)
+        except geoip2.errors.AddressNotFoundError as e:
+            return None, e.network
+        return {"number": result.autonomous_system_number, "name": result.autonomous_system_organization,
+                "network": str(result.network)}, result.network
+
+    def lookup(self, ip):
+        """(country, asn) for ``ip``, either is None when the database has no record for it."""
+        # Chrome reports IPv6 addresses in brackets
+        ip = ip.strip('[]')
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None, None
+        cached = self._cached(address)
+        if cached is not None:
+            return cached
+        country, country_network = self._country(ip)
+        asn, asn_network = self._asn(ip)
+        result = (country, asn)
+        networks = [network for network in (country_network, asn_network) if network is not None]
+        if networks:
+            # Both networks hold the IP, so the longer prefix sits inside the other one
+            self._store(max(networks, key=lambda network: network.prefixlen), result)
+        return result
+
+    def lookup_many(self, ips):
+        """``{ip: (country, asn)}`` for every distinct IP given."""
+        return {ip: self.lookup(ip) for ip in dict.fromkeys(ips) if ip}
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'networks': len(self._networks), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0}
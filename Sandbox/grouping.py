@@ -0,0 +1,112 @@
+def new_domain():
+    return {'hosting_scripts': False,
+            'mime_type': [],
+            'whois': {},
+            'resource': [],
+            'ip': '',
+            'response_code': [],
+            'request': [],
+            'sub_domain': [],
+            'total_response_size': 0.0,
+            'server': '',
+            'root': False}
+
+
+def new_server(ip):
+    return {'hosting_scripts': False,
+            'mime_type': [],
+            'ip': ip,
+            'country': None,
+            'asn': None,
+            'resource': [],
+            'response_code': [],
+            'domain': [],
+            'total_response_size': 0.0,
+            'server': []}
+
+
+def unique(values):
+    return list(dict.fromkeys(values))
+
+
+def unique_resources(resources):
+    by_hash = {}
+    for resource in resources:
+        by_hash.setdefault(resource['sha256'], resource)
+    return list(by_hash.values())
+
+
+def group_domains(raw, domain_extract):
+    """Normalized requests, resources and certificates of a report grouped by registered domain in one pass each.
+
+    Returns ``{domain: partial domain document}``, only domains that answered a request are
+    present. ``domain_extract`` is called once per url.
+    """
+    groups = {}
+    for request in raw['request']:
+        response = request['response']
+        domain, sub, tld = domain_extract(response['url'])
+        group = groups.get(domain)
+        if group is None:
+            group = groups[domain] = new_domain()
+        group['request'].append({'url': response.get('url', ''), 'mime_type': response.get('mime_type', ''),
+                                 'ip': response.get('ip', ''), 'response_code': response.get('status', ''),
+                                 'encoded_data_length': response.get('encoded_data_length', '')})
+        if not group['ip'] and response.get('ip'):
+            group['ip'] = response['ip']
+        group['total_response_size'] += float(response['encoded_data_length'])
+        group['name'] = domain
+        group['sub_domain'].append(sub)
+        group['tld'] = tld
+        group['response_code'].append(response['status'])
+        group['mime_type'].append(response['mime_type'])
+        for header in response['headers']:
+            if header['name'].lower() == 'server':
+                group['server'] = header['value']
+
+    for resource in raw['resource']:
+        group = groups.get(domain_extract(resource['url'])[0])
+        if group is not None:
+            group['resource'].append(resource)
+
+    for certificate in raw['certificate']:
+        group = groups.get(certificate['domain_name'])
+        if group is not None:
+            group['certificate'] = certificate
+
+    for group in groups.values():
+        group['response_code'] = unique(group['response_code'])
+        group['mime_type'] = unique(group['mime_type'])
+        group['sub_domain'] = unique(group['sub_domain'])
+        group['resource'] = unique_resources(group['resource'])
+        group['request_count'] = len(group['request'])
+        group['hosting_scripts'] = any('script' in mime for mime in group['mime_type'])
+    return groups
+
+
+def group_servers(domains):
+    """Domain documents merged by IP into server documents."""
+    results = {}
+    for domain in domains:
+        ip = domain['ip']
+        server = results.get(ip)
+        if server is None:
+            server = results[ip] = new_server(ip)
+            server['country'] = domain.get('country')
+            server['asn'] = domain.get('asn')
+        server['hosting_scripts'] = server['hosting_scripts'] or domain['hosting_scripts']
+        server['domain'].append(domain['name'])
+        if domain['server']:
+            server['server'].append(domain['server'])
+        server['mime_type'].extend(domain['mime_type'])
+        server['resource'].extend(domain['resource'])
+        server['response_code'].extend(domain['response_code'])
+        server['total_response_size'] += float(domain['total_response_size'])
+
+    for server in results.values():
+        server['resource'] = unique_resources(server['resource'])
+        server['response_code'] = unique(server['response_code'])
+        server['server'] = unique(server['server'])
+        server['mime_type'] = unique(server['mime_type'])
+        server['domain'] = unique(server['domain'])
+    return list(results.values())
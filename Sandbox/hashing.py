@@ -0,0 +1,74 @@
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Bytes fed to every digest at a time, small enough to stay in cache between digests
+CHUNK = 256 * 1024
+
+
+def hash_types(value):
+    """``hash_types`` option as a list, given as json ('["sha256","md5"]') or comma separated."""
+    if isinstance(value, (list, tuple)):
+        names = value
+    else:
+        value = value.strip()
+        names = json.loads(value) if value.startswith('[') else value.split(',')
+    names = [name.strip().lower() for name in names if name.strip()]
+    unknown = [name for name in names if name not in hashlib.algorithms_available]
+    if unknown:
+        raise ValueError(f'Unknown hash types {unknown}')
+    # sha256 identifies resources everywhere, it is always computed
+    return list(dict.fromkeys(['sha256'] + names))
+
+
+def body_bytes(body, base64_encoded):
+    """The response bytes CDP returned, decoding base64 bodies (images, fonts, other binary)."""
+    if base64_encoded:
+        try:
+            return base64.b64decode(body)
+        except (binascii.Error, ValueError):
+            logger.debug('Body flagged base64 failed to decode, hashing the text')
+    return body.encode('utf-8')
+
+
+def digests(data, names):
+    """Every digest in ``names`` computed in one pass over ``data``."""
+    hashers = [(name, hashlib.new(name)) for name in names]
+    view = memoryview(data)
+    for start in range(0, len(view), CHUNK):
+        chunk = view[start:start + CHUNK]
+        for name, hasher in hashers:
+            hasher.update(chunk)
+    return {name: hasher.hexdigest() for name, hasher in hashers}
+
+
+class Hasher:
+    """Hashes response bodies, bodies over ``hash_offload_bytes`` go to a thread pool.
+
+    hashlib releases the GIL on large buffers, so offloaded bodies hash in parallel while
+    the scan carries on fetching.
+    """
+
+    def __init__(self, config):
+        self.names = hash_types(config.get('hash_types', ['sha256']))
+        self.offload_bytes = int(config.get('hash_offload_bytes', 1024 * 1024))
+        self.workers = int(config.get('hash_workers', 2))
+        self.executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, data):
+        """Future for the digests of ``data``, already done for small bodies."""
+        if len(data) > self.offload_bytes:
+            with self._lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='hash')
+            return self.executor.submit(digests, data, self.names)
+        future = Future()
+        future.set_result(digests(data, self.names))
+        return future
@@ -0,0 +1,33 @@
+from functools import lru_cache
+from urllib.parse import urlparse
+
+import tldextract
+
+# Public suffix list from the snapshot bundled with tldextract, never fetched and never written
+# to a cache dir, so workers start without network access
+extractor = tldextract.TLDExtract(cache_dir=None, suffix_list_urls=())
+
+URL_CACHE_SIZE = 65536
+HOST_CACHE_SIZE = 16384
+
+
+@lru_cache(maxsize=HOST_CACHE_SIZE)
+def split_host(host):
+    """(registered domain, subdomain, suffix) of a host, ``host`` may carry a port or credentials."""
+    clean = extractor(host)
+    return clean.registered_domain, clean.subdomain, clean.suffix
+
+
+@lru_cache(maxsize=URL_CACHE_SIZE)
+def domain_extract(url):
+    return split_host(urlparse(url).netloc)
+
+
+def registered_domain(url):
+    return domain_extract(url)[0]
+
+
+def stats():
+    """Hit/miss counts of the url and host caches."""
+    return {name: {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'max_size': info.maxsize}
+            for name, info in (('url', domain_extract.cache_info()), ('host', split_host.cache_info()))}
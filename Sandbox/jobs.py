@@ -0,0 +1,69 @@
+import collections
+import threading
+import time
+from datetime import datetime, timezone
+
+
+class JobStore:
+    """Status of scans submitted through the API, oldest finished jobs dropped past ``max_jobs``."""
+
+    summary_fields = ['scan_status', 'errors', 'resolved_url', 'page_title', 'scan_time', 'meta', 'timing']
+
+    def __init__(self, max_jobs=10000):
+        self.max_jobs = max_jobs
+        self._jobs = collections.OrderedDict()
+        self._finished = collections.deque(maxlen=10000)
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+
+    def add(self, report_id, submission_url):
+        job = {'report_id': report_id, 'submission_url': submission_url, 'status': 'queued',
+               'submitted_utc': str(datetime.now(timezone.utc))[:19]}
+        with self._lock:
+            self._jobs[report_id] = job
+            self.submitted += 1
+            self._trim()
+        return dict(job)
+
+    def update(self, report_id, **fields):
+        with self._lock:
+            if report_id in self._jobs:
+                self._jobs[report_id].update(fields)
+
+    def finish(self, report_id, report):
+        result = {field: report[field] for field in self.summary_fields if field in report} if report else {}
+        with self._lock:
+            if report_id not in self._jobs:
+                return
+            self._jobs[report_id].update({'status': result.get('scan_status', 'failed'), 'result': result,
+                                          'completion_utc': str(datetime.now(timezone.utc))[:19]})
+            self.completed += 1
+            self._finished.append(time.monotonic())
+
+    def remove(self, report_id):
+        with self._lock:
+            self._jobs.pop(report_id, None)
+            self.submitted -= 1
+
+    def get(self, report_id):
+        with self._lock:
+            job = self._jobs.get(report_id)
+            return dict(job) if job else None
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            statuses = collections.Counter(job['status'] for job in self._jobs.values())
+            last_minute = sum(1 for finished in self._finished if now - finished <= 60)
+            return {'submitted': self.submitted, 'completed': self.completed, 'status': dict(statuses),
+                    'completed_last_minute': last_minute}
+
+    def _trim(self):
+        while len(self._jobs) > self.max_jobs:
+            for report_id, job in self._jobs.items():
+                if job['status'] not in ('queued', 'scanning', 'processing'):
+                    del self._jobs[report_id]
+                    break
+            else:
+                return
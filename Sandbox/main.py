@@ -1,35 +1,49 @@
 import os
+import signal
 import time
 
-import requests
-from report import Formatting, Technology, Resources, Enrichment
+from report import Resources, Enrichment
+from schema import normalize_report
 from selenium.common.exceptions import WebDriverException
 from threatai import analyze
 import argparse
 import uuid
-from selenium import webdriver
-from bs4 import BeautifulSoup
 import datetime
 from datetime import timezone
 import json
-import threading
-from opensearch import Helper, Domains, Servers
+from opensearch import Client, Helper, Domains, Servers
+from bulk import BulkWriter
+from entities import EntityCache
 from community import Democracy
+from browser import BrowserPool
+from scheduler import Scheduler
+from pipeline import Pipeline
+from screenshot import Screenshot
+from network import NetworkCollector
+from dns_cache import DNSCache
+from hashing import Hasher, hash_types
+from bodystore import BodyStore
+from archive import ArchiveStore, ReplayDriver, REPORT_FIELDS
+import hosts
+from seen import SeenSet, normalize_url, with_scheme
+from feeds import FEEDS
+from metrics import metrics, StageTimer
+from jobs import JobStore
 import logging
 import urllib3
 import distutils.util
 import queue
 import warnings
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
-from PIL import Image
-import io
-import base64
 
 warnings.filterwarnings('ignore', category=urllib3.exceptions.InsecureRequestWarning)
 
-enrich = Enrichment()
-tech = Technology()
+
+
+def dns_mode(value):
+    # dns used to be a true/false switch
+    return {'TRUE': 'ALL', 'FALSE': 'NONE'}.get(value.upper(), value.upper())
 
 
 def get_config():
@@ -37,8 +51,12 @@ def get_config():
     parser.add_argument('--resources', type=str, choices=["images", "scripts", "all", "none", "txt_html"], help='Select which resources to save to Elastic',
                         default=os.getenv('resources', 'scripts'))
     parser.add_argument('--threads', type=int, help='Count of threads to run', default=int(os.getenv('threads', 2)))
-    parser.add_argument('--source', type=str, choices=[], help='Source data which contains the domains/urls to scan',
+    parser.add_argument('--source', type=str, choices=sorted(FEEDS) + ['query', 'url', 'archive'], help='Source data which contains the domains/urls to scan, archive replays the scan archives in archive_dir',
                         default=os.getenv('source', 'openphish'))
+    parser.add_argument('--feed_interval', type=int, help='Seconds between feed polls, 0 polls once and exits',
+                        default=int(os.getenv('feed_interval', 0)))
+    parser.add_argument('--feed_state_dir', type=str, help='Directory holding the last snapshot of each feed',
+                        default=os.getenv('feed_state_dir', 'feed_state'))
     parser.add_argument('--elastic_query', type=str, help='Query to use when source is set to query',
                         default=os.getenv('elastic_query', ''))
     parser.add_argument('--elastic_size', type=int, help='Max results to return from elasticsearch query',
@@ -47,8 +65,38 @@ def get_config():
                         default=os.getenv('tag', ''))
     parser.add_argument('--save_screenshot', type=str, help='Save screenshot true/false',
                         default=str(os.getenv('save_screenshot', "False")))
+    parser.add_argument('--screenshot_mode', type=str, choices=["viewport", "full"], help='Capture the viewport or the full page',
+                        default=os.getenv('screenshot_mode', 'viewport'))
+    parser.add_argument('--screenshot_quality', type=int, help='JPEG quality of screenshots (0-100)',
+                        default=int(os.getenv('screenshot_quality', 50)))
+    parser.add_argument('--screenshot_scale', type=float, help='Scale applied to screenshots by Chrome',
+                        default=float(os.getenv('screenshot_scale', 0.5)))
+    parser.add_argument('--screenshot_thumbnail', type=str, help='Also save a thumbnail bounded to WIDTHxHEIGHT e.g. 320x240',
+                        default=os.getenv('screenshot_thumbnail', ''))
+    parser.add_argument('--screenshot_encoders', type=int, help='Threads encoding screenshot thumbnails',
+                        default=int(os.getenv('screenshot_encoders', 2)))
+    parser.add_argument('--max_requests', type=int, help='Max network requests recorded per scan',
+                        default=int(os.getenv('max_requests', 5000)))
     parser.add_argument('--scan_timeout', type=int, help='Time in seconds to wait for url to load',
                         default=int(os.getenv('scan_timeout', 30)))
+    parser.add_argument('--browser_recycle', type=int, help='Scans a pooled Chrome session runs before it is replaced',
+                        default=int(os.getenv('browser_recycle', 50)))
+    parser.add_argument('--retries', type=int, help='Times to retry a url that failed with a transient error',
+                        default=int(os.getenv('retries', 2)))
+    parser.add_argument('--retry_backoff', type=float, help='Seconds to wait before the first retry, doubled for each retry after',
+                        default=float(os.getenv('retry_backoff', 5)))
+    parser.add_argument('--progress_interval', type=int, help='Seconds between progress/ETA log lines, 0 to disable',
+                        default=int(os.getenv('progress_interval', 30)))
+    parser.add_argument('--api_queue_size', type=int, help='Max scans waiting in the API queue before /scan answers 429',
+                        default=int(os.getenv('api_queue_size', 10000)))
+    parser.add_argument('--api_max_jobs', type=int, help='Finished API jobs kept for GET /scan/<report_id>',
+                        default=int(os.getenv('api_max_jobs', 10000)))
+    parser.add_argument('--enrich_workers', type=int, help='Processes building reports from browser captures, empty for one per CPU',
+                        default=int(os.getenv('enrich_workers') or os.cpu_count() or 2))
+    parser.add_argument('--persist_workers', type=int, help='Threads saving finished reports',
+                        default=int(os.getenv('persist_workers', 2)))
+    parser.add_argument('--stage_queue_size', type=int, help='Reports waiting between pipeline stages before capture blocks',
+                        default=int(os.getenv('stage_queue_size', 16)))
     parser.add_argument('--save_elastic', type=str, help='Save data (report/resources) to elastic',
                         default=str(os.getenv('save_elastic', "True")))
     parser.add_argument('--save_dom', type=str, help='Save DOM to elastic',
@@ -57,12 +105,26 @@ def get_config():
                         default=str(os.getenv('threat_ai', "False")))
     parser.add_argument('--threat_ai_endpoint', type=str, help='Webamon AI endpoint for LLM',
                         default=str(os.getenv('threat_ai_endpoint', '')))
-    parser.add_argument('--hash_types', type=list, help='List of hash types to compute for resources',
-                        default=list(os.getenv('hash_types', ["sha256"])))
+    parser.add_argument('--hash_types', type=str, help='Hash types to compute for resources, json list or comma separated e.g. ["sha256","sha1","md5"]',
+                        default=os.getenv('hash_types', '["sha256"]'))
+    parser.add_argument('--hash_workers', type=int, help='Threads hashing large response bodies',
+                        default=int(os.getenv('hash_workers', 2)))
+    parser.add_argument('--hash_offload_bytes', type=int, help='Bodies over this size are hashed on the hash_workers pool',
+                        default=int(os.getenv('hash_offload_bytes', 1024 * 1024)))
     parser.add_argument('--whois', type=str, choices=["ALL", "MAIN", "NONE"], help='Lookup Domain(s) WHOIS info',
                         default=os.getenv('whois', 'NONE'))
-    parser.add_argument('--dns', type=str, choices=["ALL", "MAIN", "NONE"], help='Lookup Domain(s) DNS info',
+    parser.add_argument('--dns', type=dns_mode, choices=["ALL", "MAIN", "NONE"], help='Lookup Domain(s) DNS info, MAIN for the scanned domain only',
                         default=os.getenv('dns', 'NONE'))
+    parser.add_argument('--dns_workers', type=int, help='Concurrent DNS queries',
+                        default=int(os.getenv('dns_workers', 32)))
+    parser.add_argument('--dns_timeout', type=float, help='Seconds before a DNS query is given up',
+                        default=float(os.getenv('dns_timeout', 5)))
+    parser.add_argument('--dns_cache_size', type=int, help='DNS answers kept in the cache',
+                        default=int(os.getenv('dns_cache_size', 100000)))
+    parser.add_argument('--dns_max_ttl', type=int, help='Longest time in seconds a DNS answer is cached, answers are cached for their TTL up to this',
+                        default=int(os.getenv('dns_max_ttl', 3600)))
+    parser.add_argument('--dns_negative_ttl', type=int, help='Seconds empty DNS answers and NXDOMAIN are cached',
+                        default=int(os.getenv('dns_negative_ttl', 300)))
     parser.add_argument('--scan_type', type=str, choices=["NONE","daily_openphish"], help='Run a pre-configured scan config template',
                         default=os.getenv('scan_type', 'NONE'))
     parser.add_argument('--check_dangling', type=str, choices=["ALL", "MAIN", "NONE"], help='Check for dangling dns records',
@@ -99,8 +161,34 @@ def get_config():
                         default=os.getenv('save_resources', "False"))
     parser.add_argument('--elastic_base', type=str, help='Base url for elastic',
                         default=os.getenv('elastic_base', 'https://localhost:9200'))
+    parser.add_argument('--elastic_pool_size', type=int, help='Connections kept open to OpenSearch and shared by every thread saving reports',
+                        default=int(os.getenv('elastic_pool_size', 10)))
+    parser.add_argument('--elastic_timeout', type=float, help='Seconds to wait for an OpenSearch response',
+                        default=float(os.getenv('elastic_timeout', 300)))
+    parser.add_argument('--elastic_connect_timeout', type=float, help='Seconds to wait for a connection to OpenSearch',
+                        default=float(os.getenv('elastic_connect_timeout', 10)))
+    parser.add_argument('--elastic_compress_bytes', type=int, help='OpenSearch request bodies over this size are gzipped, 0 to disable',
+                        default=int(os.getenv('elastic_compress_bytes', 16384)))
+    parser.add_argument('--bulk_flush_bytes', type=int, help='Buffered bulk bytes that trigger a _bulk request',
+                        default=int(os.getenv('bulk_flush_bytes', 5 * 1024 * 1024)))
+    parser.add_argument('--bulk_flush_interval', type=float, help='Longest time in seconds a document waits in the bulk buffer',
+                        default=float(os.getenv('bulk_flush_interval', 1)))
+    parser.add_argument('--bulk_max_pending_bytes', type=int, help='Bytes waiting to be written before saves block until OpenSearch catches up',
+                        default=int(os.getenv('bulk_max_pending_bytes', 50 * 1024 * 1024)))
+    parser.add_argument('--bulk_retries', type=int, help='Times a rejected bulk item or failed _bulk request is sent again',
+                        default=int(os.getenv('bulk_retries', 3)))
+    parser.add_argument('--bulk_retry_backoff', type=float, help='Seconds before the first bulk retry, doubled on each further attempt',
+                        default=float(os.getenv('bulk_retry_backoff', 1)))
+    parser.add_argument('--entity_max_resources', type=int, help='Resources kept on a domain or server document, the most recently seen first',
+                        default=int(os.getenv('entity_max_resources', 1000)))
+    parser.add_argument('--entity_flush_interval', type=float, help='Seconds domain and server observations are coalesced in memory before one update per entity is written, 0 writes every observation',
+                        default=float(os.getenv('entity_flush_interval', 30)))
+    parser.add_argument('--entity_cache_size', type=int, help='Domains and servers coalesced in memory before they are written early',
+                        default=int(os.getenv('entity_cache_size', 10000)))
     parser.add_argument('--skip_if_exists', type=str, help='Skip if the url has been scanned previously',
                         default=str(os.getenv('skip_if_exists', "False")))
+    parser.add_argument('--seen_path', type=str, help='File of previously scanned url hashes used by skip_if_exists, empty to disable',
+                        default=os.getenv('seen_path', 'seen_urls.bin'))
     parser.add_argument('--elastic_query_index', type=str, help='Index to user with elastic_query',
                         default=os.getenv('elastic_query_index', 'feeds'))
     parser.add_argument('--queue_worker', type=str, help='Always on, consumes queue',
@@ -113,6 +201,20 @@ def get_config():
                         default=os.getenv('save_images', 'False'))
     parser.add_argument('--save_css', type=str, help='Save CSS Mime Types',
                         default=os.getenv('save_css', 'False'))
+    parser.add_argument('--save_fonts', type=str, help='Save Font Mime Types',
+                        default=os.getenv('save_fonts', 'False'))
+    parser.add_argument('--max_body_bytes', type=int, help='Response bodies over this size are stored truncated, 0 for no limit',
+                        default=int(os.getenv('max_body_bytes', 5 * 1024 * 1024)))
+    parser.add_argument('--max_scan_bytes', type=int, help='Total response body bytes fetched per scan, 0 for no limit',
+                        default=int(os.getenv('max_scan_bytes', 50 * 1024 * 1024)))
+    parser.add_argument('--body_store_dir', type=str, help='Directory response bodies over body_spill_bytes are spilled to while a report is in flight, empty keeps every body in memory',
+                        default=os.getenv('body_store_dir', 'body_store'))
+    parser.add_argument('--body_spill_bytes', type=int, help='Response bodies over this size are kept on disk rather than in memory until saved',
+                        default=int(os.getenv('body_spill_bytes', 1024 * 1024)))
+    parser.add_argument('--archive', type=str, help='Write a compressed archive of every capture to archive_dir for replay',
+                        default=os.getenv('archive', 'False'))
+    parser.add_argument('--archive_dir', type=str, help='Directory of scan archives, written with archive and replayed with source archive',
+                        default=os.getenv('archive_dir', 'archive'))
     parser.add_argument('--set_cookies', type=str, help='Set + Change Cookies, dictionary format',
                         default=os.getenv('set_cookies', '{}'))
     parser.add_argument('--log_level', type=str, choices=["INFO", "DEBUG"], help='Set Logging Level INFO/DEBUG',
@@ -133,64 +235,100 @@ def get_config():
     args['queue_worker'] = bool(distutils.util.strtobool(args['queue_worker']))
     args['save_images'] = bool(distutils.util.strtobool(args['save_images']))
     args['save_css'] = bool(distutils.util.strtobool(args['save_css']))
+    args['save_fonts'] = bool(distutils.util.strtobool(args['save_fonts']))
     args['community'] = bool(distutils.util.strtobool(args['community']))
+    args['hash_types'] = hash_types(args['hash_types'])
+    args['archive'] = bool(distutils.util.strtobool(args['archive'])) and args['source'] != 'archive'
 
     return args
 
 
-config = get_config()
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-logging.basicConfig(level=eval(f'logging.{config["log_level"].upper()}'))
 logger = logging.getLogger(__name__)
-engine_log = {"start_utc": str(datetime.datetime.now(timezone.utc))[:19], "date": datetime.datetime.utcnow().strftime("%Y-%m-%d"), "errors": [], "tag": [], 'engine_id': str(uuid.uuid4())}
 app = Flask(__name__)
 CORS(app)
-q = queue.Queue()
-
-if config['community']:
-    democracy = Democracy(config)
-    config['save_elastic'] = False
-elif config['save_elastic']:
-    OpenSearch = Helper(config)
-    domains = Domains(config)
-    servers = Servers(config)
-
+# The feed watch_feed is scanning, told when each of its urls is finished
+watched = None
 
-counter = 0
-success = 0
-failed = 0
-skipped = 0
 
+def setup():
+    """Builds the engine. Kept out of the module top level: the spawned enrichment processes
+    import this module as __mp_main__ and must not start any of it."""
+    global config, engine_log, jobs, democracy, client, writer, OpenSearch, entities, domains, servers, browsers, screenshots, \
+        seen, dns_cache, hasher, bodies, archives, pipeline, job_scheduler
+    config = get_config()
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    logging.basicConfig(level=eval(f'logging.{config["log_level"].upper()}'))
+    engine_log = {"start_utc": str(datetime.datetime.now(timezone.utc))[:19], "date": datetime.datetime.utcnow().strftime("%Y-%m-%d"), "errors": [], "tag": [], 'engine_id': str(uuid.uuid4())}
+    jobs = JobStore(config['api_max_jobs'])
 
-def get_openPhish():
-    response = requests.get("https://www.openphish.com/feed.txt")
-    if response.status_code == 200:
-        _urls = response.text.splitlines()
-        return _urls
-    else:
-        print(f"Failed to retrieve data: {response.status_code}")
-        return False
+    if config['community']:
+        democracy = Democracy(config)
+        config['save_elastic'] = False
+    elif config['save_elastic']:
+        client = Client(config)
+        writer = BulkWriter(client, config)
+        OpenSearch = Helper(config, client, writer)
+        entities = EntityCache(writer, config)
+        domains = Domains(config, client, writer, entities)
+        servers = Servers(config, client, writer, entities)
+
+    browsers = BrowserPool(config)
+    screenshots = Screenshot(config)
+    seen = SeenSet(config['seen_path'])
+    dns_cache = DNSCache(config)
+    hasher = Hasher(config)
+    bodies = BodyStore(config['body_store_dir'], config['body_spill_bytes'])
+    archives = ArchiveStore(config['archive_dir'] if config['archive'] or config['source'] == 'archive' else '')
+    pipeline = Pipeline(config, persist, on_done=report_done)
+    job_scheduler = Scheduler(scan_job, config['threads'], on_done=finish_job, retry_if=is_transient, on_retry=discard, retries=config['retries'],
+                              backoff=config['retry_backoff'], max_pending=config['api_queue_size'], progress_interval=0, name='api')
+    metrics.register(queue_gauges)
 
 
 @app.route('/scan', methods=['POST'])
 def enqueue():
     data = request.json
-    report_id = ''
-    if 'report_id' in data:
-        report_id = data['report_id']
-    report = phuck(data['submission_url'], report_id)
-    if config['community']:
-        democracy.save(Formatting.clean_data(report))
-    elif config['save_elastic']:
-        OpenSearch.save_report(Formatting.clean_data(report))
-        if 'domain' in report:
-            for domain in report['domain']:
-                domains.update(domain)
-
-        if 'server' in report:
-            for server in report['server']:
-                servers.update(server)
-    return jsonify({"scan_status": report['scan_status'], "data": {"submission_url": data['submission_url'], 'report_id': report['report_id']}}), 200
+    submissions = data if isinstance(data, list) else data.get('submissions', [data])
+    accepted = []
+    for submission in submissions:
+        if isinstance(submission, str):
+            submission = {'submission_url': submission}
+        if not submission.get('submission_url'):
+            return jsonify({"error": "submission_url is required", "data": accepted}), 400
+        report_id = submission.get('report_id') or str(uuid.uuid4())
+        job = jobs.add(report_id, submission['submission_url'])
+        try:
+            job_scheduler.submit((submission['submission_url'], report_id), block=False)
+        except queue.Full:
+            jobs.remove(report_id)
+            return jsonify({"error": "Scan queue is full, retry later", "data": accepted}), 429
+        accepted.append({"submission_url": job['submission_url'], "report_id": report_id})
+    if isinstance(data, dict) and 'submissions' not in data:
+        return jsonify({"scan_status": "queued", "report_id": accepted[0]['report_id'], "data": accepted[0]}), 202
+    return jsonify({"scan_status": "queued", "data": accepted}), 202
+
+
+@app.route('/scan/<report_id>', methods=['GET'])
+def scan_status(report_id):
+    job = jobs.get(report_id)
+    if not job:
+        return jsonify({"error": "Unknown report_id"}), 404
+    return jsonify(job), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/queue', methods=['GET'])
+def queue_status():
+    status = {"scheduler": job_scheduler.progress(), "pipeline": pipeline.stats(), "jobs": jobs.stats(), "browser": browsers.stats(),
+              "dns": dns_cache.stats(), "bodies": bodies.stats()}
+    if config['save_elastic']:
+        status['bulk'] = writer.stats()
+        status['entities'] = entities.stats()
+    return jsonify(status), 200
 
 
 def set_cookies(driver, domain):
@@ -204,102 +342,43 @@ def set_cookies(driver, domain):
 
 
 def phuck(url, report_id=''):
-    time.sleep(1)
-    global counter, success, failed
-    url = url if url.startswith('https://') or url.startswith('http://') else f'https://{url}'
+    url = with_scheme(url)
     start = datetime.datetime.now()
     network_data = {'request': {}, 'submission_utc': str(datetime.datetime.now(timezone.utc))[:19], 'tag': config['tag'], 'report_id': report_id if report_id else str(uuid.uuid4()), 'submission_url': url,
                     'source': config['source'], "feed": config['feed'], "date": datetime.datetime.utcnow().strftime("%Y-%m-%d"), "save_resources": config['resources'], "engine_id": engine_log['engine_id'], "errors": []}
-    network_data['domain_name'], network_data['sub_domain'], network_data['tld'] = enrich.domain_extract(url)
-    options = webdriver.ChromeOptions()
-    service = webdriver.ChromeService("/app/chromedriver")
-    options.binary_location = '/app/chrome/chrome'
-    options.add_argument("--headless")
-    options.add_argument('--no-sandbox')
-    options.add_argument("--disable-gpu")
-    options.add_argument('--ignore-ssl-errors')
-    options.add_argument('--ignore-certificate-errors')
-    options.add_argument("--window-size=1280x1696")
-    options.add_argument("--single-process")
-    options.add_argument("--disable-dev-shm-usage")
-    options.add_argument("--disable-dev-tools")
-    options.add_argument("--no-zygote")
-    options.add_argument(f"user-agent={config['user_agent']}")
-    options.set_capability('goog:loggingPrefs', {'browser': 'ALL', 'performance': 'ALL'})
-    chrome = set_cookies(webdriver.Chrome(options=options, service=service), network_data['domain_name'])
-    chrome.execute_cdp_cmd("Network.enable", {})
-    chrome.set_page_load_timeout(config['scan_timeout'])
+    network_data['domain_name'], network_data['sub_domain'], network_data['tld'] = Enrichment.domain_extract(url)
+    session = browsers.acquire()
+    chrome = session.driver
+    network_data['timing'] = {'browser_launch': round(session.launch_time, 3) if session.fresh else 0.0}
+    network_data['browser'] = {'reused': not session.fresh, 'session_scans': session.scans}
+    timer = StageTimer(network_data['timing'])
+    collector = NetworkCollector(config['max_requests'], keep_log=config['archive'])
 
     try:
-        chrome.get(url)
-        network_data['dom'] = chrome.page_source
-        network_data['page_title'] = chrome.title
-        network_data['resolved_url'] = chrome.current_url
-        network_data['cookie'] = chrome.get_cookies()
-        network_data['resolved_domain'], network_data['resolved_sub_domain'], network_data['resolved_tld'] = enrich.domain_extract(network_data['resolved_url'])
-        performance_logs = chrome.get_log('performance')
-        network_data = enrich.response_data(performance_logs, network_data)
-        network_data['resource'], network_data['resource_master'] = Resources.getResources(network_data['request'], chrome, network_data['report_id'], url)
+        set_cookies(chrome, network_data['domain_name'])
+        with timer.stage('navigation'):
+            chrome.get(url)
+            network_data['dom'] = chrome.page_source
+            network_data['page_title'] = chrome.title
+            network_data['resolved_url'] = chrome.current_url
+            network_data['cookie'] = chrome.get_cookies()
+        network_data['resolved_domain'], network_data['resolved_sub_domain'], network_data['resolved_tld'] = Enrichment.domain_extract(network_data['resolved_url'])
+        with timer.stage('network_log'):
+            network_data['request'] = collector.drain(chrome)
+        with timer.stage('body_fetch'):
+            network_data['resource'], network_data['resource_master'], network_data['resource_stats'] = Resources.getResources(network_data['request'], chrome, network_data['report_id'], url, config, hasher, bodies)
         if config['save_screenshot']:
-            x = chrome.get_screenshot_as_base64()
-            screenshot_base64 = chrome.get_screenshot_as_base64()
-            screenshot_bytes = base64.b64decode(screenshot_base64)
-            image = Image.open(io.BytesIO(screenshot_bytes))
-            if image.mode == 'RGBA':
-                image = image.convert('RGB')
-            new_width = image.width // 2  # For example, reduce by 50%
-            new_height = image.height // 2
-            resized_image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            buffer = io.BytesIO()
-            resized_image.save(buffer, format="JPEG", quality=50)  # quality=50 reduces the image quality
-            compressed_image_bytes = buffer.getvalue()
-            compressed_image_base64 = base64.b64encode(compressed_image_bytes).decode('utf-8')
-            OpenSearch.raw_save('screenshots',
-                                {"screenshot": compressed_image_base64, "page_title": network_data['page_title'],
-                                 "domain_name": network_data['domain_name'], "tag": network_data['tag'], 'date': network_data["date"],
-                                 "submission_url": network_data['submission_url']}, network_data['report_id'])
-        soup = BeautifulSoup(network_data['dom'], 'html.parser')
-        script_tags = soup.find_all('script')
-        link_tags = soup.find_all('link')
-        network_data['page_links'] = [str(x) for x in link_tags]
-        network_data['page_scripts'] = [str(x) for x in script_tags]
-        network_data['technology'] = tech.getTech(script_tags, link_tags, network_data['request'])
-        _subs = []
-        certs = []
-        requestlist = []
-
-        bad_starts = ["blob", "data"]
-        keys_to_delete = []
-        for x in network_data['request']:
-            if 'response' in network_data['request'][x]:
-                request_url = network_data['request'][x]['request']['url']
-                response_url = network_data['request'][x]['response']['url']
-                if request_url[:4] in bad_starts or response_url[:4] in bad_starts:
-                    keys_to_delete.append(x)
-                    continue
-                if 'securityDetails' in network_data['request'][x]['response']:
-                    _ = network_data['request'][x]['response']['securityDetails']
-                    _['domain_name'], _['sub_domain'], _['tld'] = enrich.domain_extract(request_url)
-                    sub_name = network_data['request'][x]['response']['securityDetails']['subjectName']
-                    if sub_name not in _subs:
-                        certs.append(network_data['request'][x]['response']['securityDetails'])
-                        _subs.append(sub_name)
-                requestlist.append(network_data['request'][x])
-        for key in keys_to_delete:
-            del network_data['request'][key]
-        network_data['certificate'] = certs
-        network_data['request'] = requestlist
-        network_data = Formatting.transform_headers(network_data)
-        for x in network_data['certificate']:
-            x['valid_from_utc'] = str(datetime.datetime.fromtimestamp(x['validFrom'], datetime.UTC))
-            x['valid_to_utc'] = str(datetime.datetime.fromtimestamp(x['validTo'], datetime.UTC))
-        network_data['domain'] = enrich.thirdParties(network_data, network_data['resolved_url'])
-        network_data['server'] = enrich.server_data(network_data)
-        network_data = enrich.scanMeta(network_data)
-        network_data['scan_status'] = "success"
-        if config['threat_ai']:
-            network_data['threat_ai'] = analyze(network_data, config['threat_ai_endpoint'])
+            with timer.stage('screenshot'):
+                network_data['screenshot'] = screenshots.capture(chrome, network_data['report_id'])
+            network_data['screenshot_size'] = len(network_data['screenshot']) * 3 // 4
+        with timer.stage('network_log'):
+            collector.drain(chrome)
+        network_data['network'] = collector.stats()
+        if config['archive']:
+            network_data['performance_log'] = collector.log
+        network_data['scan_status'] = "captured"
     except WebDriverException as e:
+        session.check(e)
         if "unknown error: net::ERR_NAME_NOT_RESOLVED" in str(e):
             logger.critical(f"Not Resolved - {url}")
             network_data['errors'].append({'error': 'ERR_NAME_NOT_RESOLVED', 'url': url})
@@ -308,57 +387,89 @@ def phuck(url, report_id=''):
             network_data['errors'].append({'error': 'ERR_CONNECTION_REFUSED', 'url': url})
         else:
             network_data['errors'].append({'error': str(e), 'url': url})
-        failed += 1
         network_data['scan_status'] = "failed"
     except Exception as e:
-        failed += 1
         network_data['scan_status'] = "failed"
         network_data['errors'].append({'error': str(e), 'url': url})
         print('uncaught error')
         print(e)
     finally:
-        chrome.quit()
-        network_data['completion_utc'] = str(datetime.datetime.now(timezone.utc))[:19]
+        browsers.release(session, collector.origins())
         end = datetime.datetime.now()
         network_data['scan_time'] = str(end - start)
+        network_data['timing']['capture'] = round((end - start).total_seconds(), 3)
         # print(json.dumps(network_data, indent=4))
         return network_data
 
 
-def chunk_list(lst, num_chunks):
-    chunk_size = len(lst) // num_chunks
-    chunks = [lst[i:i+chunk_size] for i in range(0, len(lst), chunk_size)]
-    if len(chunks) > num_chunks:
-        chunks[-2] += chunks[-1]
-        chunks = chunks[:-1]
-    return chunks
-
-
-def process_chunk(chunk):
-    global counter, success, failed, errors, skipped
-
-    for url in chunk:
-        if config['skip_if_exists']:
-            previously_scanned = OpenSearch.value_exists('submission_url', url, 'scans', 'report_id')
-            if previously_scanned:
-                logger.info(f'Skipping - Scanned Previously {url} - Previous Report: {previously_scanned}')
-                skipped += 1
-                counter += 1
-                continue
-
-        report = Formatting.clean_data(phuck(url))
-        counter += 1
+TRANSIENT_ERRORS = ['ERR_CONNECTION_RESET', 'ERR_CONNECTION_CLOSED', 'ERR_CONNECTION_TIMED_OUT', 'ERR_TIMED_OUT',
+                    'ERR_NETWORK_CHANGED', 'ERR_EMPTY_RESPONSE', 'ERR_PROXY_CONNECTION_FAILED', 'chrome not reachable',
+                    'invalid session id', 'tab crashed']
+
+
+def prefilter(urls):
+    """Drop duplicate urls and, with skip_if_exists, urls already scanned locally or in OpenSearch."""
+    batch = {}
+    for url in urls:
+        if url.strip():
+            batch.setdefault(normalize_url(url), with_scheme(url))
+    duplicates = len(urls) - len(batch)
+    if config['skip_if_exists']:
+        batch = {key: url for key, url in batch.items() if url not in seen}
+        if config['save_elastic'] and batch:
+            previously_scanned = OpenSearch.existing_values('submission_url', batch.values(), 'scans', 'report_id')
+            for url, report_id in previously_scanned.items():
+                logger.debug(f'Skipping - Scanned Previously {url} - Previous Report: {report_id}')
+                seen.add(url)
+            batch = {key: url for key, url in batch.items() if url not in previously_scanned}
+    dropped = len(urls) - len(batch)
+    metrics.inc('scans', dropped, status='skipped')
+    logger.info(f'Scanning {len(batch)} of {len(urls)} urls - {duplicates} duplicates, {dropped - duplicates} scanned previously')
+    return list(batch.values())
+
+
+def is_transient(report):
+    if not report or report['scan_status'] != 'failed':
+        return False
+    return any(error in str(report['errors']) for error in TRANSIENT_ERRORS)
 
-        if report and report['scan_status'] != 'failed':
-            success += 1
-            report['scan_status'] = 'success'
 
+def persist(report):
+    # Persistence is the last stage that reads the bodies, the report gives them back to the store when it is done
+    stored = list(report.get('resource_master', {}))
+    try:
+        return save(report)
+    finally:
+        bodies.release(stored)
+
+
+def save(report):
+    timer = StageTimer(report['timing'])
+    if report['scan_status'] == 'success':
+        with timer.stage('dns'):
+            dns_cache.enrich(report)
+    if report['scan_status'] == 'success' and config['threat_ai']:
+        with timer.stage('threat_ai'):
+            report['threat_ai'] = analyze(report, config['threat_ai_endpoint'], bodies)
+    screenshot = report.pop('screenshot', False)
+    thumbnail, report['timing']['screenshot_thumbnail'] = screenshots.thumbnail(report['report_id'])
+    if screenshot and config['save_elastic']:
+        screenshot_doc = {"screenshot": screenshot, "page_title": report['page_title'],
+                          "domain_name": report['domain_name'], "tag": report['tag'], 'date': report["date"],
+                          "submission_url": report['submission_url']}
+        if thumbnail:
+            screenshot_doc['thumbnail'] = thumbnail
+        with timer.stage('persistence'):
+            OpenSearch.bulk_save('screenshots', screenshot_doc, report['report_id'])
+    report = normalize_report(report)
+    report['completion_utc'] = str(datetime.datetime.now(timezone.utc))[:19]
+
+    with timer.stage('persistence'):
         if config['community']:
-            democracy.save(report)
-            return
+            democracy.save(report, bodies)
 
         elif config['save_elastic']:
-            OpenSearch.save_report(report)
+            OpenSearch.save_report(report, bodies)
 
             if 'domain' in report:
                 for domain in report['domain']:
@@ -367,23 +478,169 @@ def process_chunk(chunk):
             if 'server' in report:
                 for server in report['server']:
                     servers.update(server)
+    return report
+
 
+def report_done(report):
+    if config['save_elastic'] or report['scan_status'] != 'failed':
+        seen.add(report['submission_url'])
+    metrics.observe_report(report)
+    jobs.finish(report['report_id'], report)
+    if watched:
+        watched.done(report['submission_url'])
 
 
-def process_chunks_in_parallel(lst):
-    num_threads = int(config['threads'])
-    chunks = chunk_list(lst, num_threads)
-    threads = []
-    for chunk in chunks:
-        thread = threading.Thread(target=process_chunk, args=(chunk,))
-        thread.start()
-        threads.append(thread)
-    for thread in threads:
-        thread.join()
+def replay(path):
+    """Rebuilds the capture half of a report from a scan archive, enrichment and persistence then run as for a live scan."""
+    start = datetime.datetime.now()
+    archive = archives.read(path)
+    network_data = {field: archive[field] for field in REPORT_FIELDS if field in archive}
+    network_data.update({'request': {}, 'errors': [], 'timing': {}, 'save_resources': config['resources'], 'engine_id': engine_log['engine_id'],
+                         'replay_utc': str(datetime.datetime.now(timezone.utc))[:19]})
+    if not config['save_screenshot']:
+        network_data.pop('screenshot', None)
+    network_data['domain_name'], network_data['sub_domain'], network_data['tld'] = Enrichment.domain_extract(network_data['submission_url'])
+    network_data['resolved_domain'], network_data['resolved_sub_domain'], network_data['resolved_tld'] = Enrichment.domain_extract(network_data['resolved_url'])
+    timer = StageTimer(network_data['timing'])
+    collector = NetworkCollector(config['max_requests'])
+    with timer.stage('network_log'):
+        network_data['request'] = collector.feed(archive['performance_log'])
+    with timer.stage('body_fetch'):
+        network_data['resource'], network_data['resource_master'], network_data['resource_stats'] = Resources.getResources(
+            network_data['request'], ReplayDriver(archive), network_data['report_id'], network_data['submission_url'], config, hasher, bodies)
+    network_data['network'] = collector.stats()
+    network_data['scan_status'] = "captured"
+    end = datetime.datetime.now()
+    network_data['scan_time'] = str(end - start)
+    network_data['timing']['capture'] = round((end - start).total_seconds(), 3)
+    return network_data
+
+
+def discard(item, report):
+    """A capture thrown away for a retry gives its bodies back to the store and drops its thumbnail."""
+    if report:
+        bodies.release(report.get('resource_master', {}))
+        screenshots.discard(report['report_id'])
+
+
+def archive_capture(report):
+    """Takes the raw event log off a capture, writing the scan archive with archive on. Every
+    capture goes through here before the pipeline, the log is never enriched or indexed."""
+    log = report.pop('performance_log', None)
+    if log is not None and report['scan_status'] == 'captured':
+        try:
+            archives.write(report, log, bodies)
+        except OSError as e:
+            logger.critical(f"Failed to archive {report['submission_url']} - {e}")
+
+
+def capture_done(url, report):
+    if report is None:
+        # The handler raised on its last attempt, counted as a failed scan with no report
+        logger.critical(f"Scan failed without a report - {url}")
+        engine_log['errors'].append({'error': 'scan raised without a report', 'url': url})
+        metrics.inc('scans', status='failed')
+        if watched:
+            watched.done(url)
+        return
+    archive_capture(report)
+    pipeline.submit(report)
+
+
+def scan_batch(urls, handler=phuck):
+    scheduler = Scheduler(handler, config['threads'], on_done=capture_done, retry_if=is_transient, on_retry=discard, retries=config['retries'],
+                          backoff=config['retry_backoff'], progress_interval=config['progress_interval'])
+    scheduler.run(urls)
+    pipeline.join()
+    return scheduler.progress()
+
+
+def watch_feed(feed):
+    """Continuous feed mode, polls every feed_interval seconds and queues only urls new to the feed.
+
+    The feed keeps the urls queued and not yet through the pipeline, a restart scans them first.
+    """
+    global watched
+    watched = feed
+    resumed = feed.resume()
+    scheduler = Scheduler(phuck, config['threads'], on_done=capture_done, retry_if=is_transient, on_retry=discard, retries=config['retries'],
+                          backoff=config['retry_backoff'], progress_interval=config['progress_interval'])
+    browsers.warm(config['threads'])
+    pipeline.start()
+    scheduler.start()
+    try:
+        while True:
+            polled = time.monotonic()
+            urls = prefilter(resumed + feed.poll())
+            resumed = []
+            feed.queue(urls)
+            for url in urls:
+                scheduler.submit(url)
+            feed.commit()
+            seen.flush()
+            logger.info(f"{feed.name} feed stats {json.dumps(feed.stats)} - {scheduler.summary()}")
+            time.sleep(max(config['feed_interval'] - (time.monotonic() - polled), 0))
+    finally:
+        scheduler.close()
+        pipeline.join()
+        feed.commit()
+        browsers.close()
+        pipeline.close()
+        bodies.close()
+        seen.flush()
+        if config['save_elastic']:
+            entities.close()
+            writer.close()
+
+
+def scan_job(job):
+    url, report_id = job
+    jobs.update(report_id, status='scanning')
+    return phuck(url, report_id)
+
+
+def finish_job(job, report):
+    url, report_id = job
+    if report is None:
+        # The scan raised on its last attempt, there is no report to enrich
+        logger.critical(f"Scan failed without a report - {url}")
+        metrics.inc('scans', status='failed')
+        jobs.finish(report_id, None)
+        return
+    jobs.update(report_id, status='processing')
+    archive_capture(report)
+    pipeline.submit(report)
+
+
+def queue_gauges():
+    progress = job_scheduler.progress()
+    gauges = [('api_queue_depth', {}, progress['queued']), ('api_in_flight', {}, progress['in_flight'])]
+    for stage, stats in pipeline.stats().items():
+        if isinstance(stats, dict):
+            gauges.append(('pipeline_queue_depth', {'stage': stage}, stats['depth']))
+            gauges.append(('pipeline_in_flight', {'stage': stage}, stats['in_flight']))
+    for name, value in browsers.stats().items():
+        gauges.append((f'browser_{name}', {}, value))
+    if config['save_elastic']:
+        for name, value in client.stats().items():
+            gauges.append((f'opensearch_{name}', {}, value))
+        gauges.append(('bulk_pending_bytes', {}, writer.stats()['pending_bytes']))
+        gauges.append(('entity_cache_pending', {}, entities.stats()['pending']))
+    store = bodies.stats()
+    gauges.append(('body_store_bytes', {'where': 'memory'}, store['memory_bytes']))
+    gauges.append(('body_store_bytes', {'where': 'disk'}, store['disk_bytes']))
+    gauges.append(('body_store_bodies', {}, store['bodies']))
+    return gauges
+
+
+def terminate(signum, frame):
+    # docker stop sends SIGTERM, unwinding like Ctrl-C lets every mode drain and write what it still buffers
+    raise SystemExit(0)
 
 
 def main():
-    global success, failed, errors, urls, skipped
+    setup()
+    signal.signal(signal.SIGTERM, terminate)
     start = datetime.datetime.now()
 
     if not config['queue_worker']:
@@ -396,20 +653,55 @@ def main():
                 except:
                     _urls.append(record['fields']['domain'])
             urls = _urls
-        elif config['source'] == 'openphish':
-            urls = get_openPhish()
+        elif config['source'] in FEEDS:
+            feed = FEEDS[config['source']](config)
+            if config['feed_interval']:
+                watch_feed(feed)
+                return
+            urls = feed.poll()
+            engine_log['feed'] = feed.stats
             if not urls:
                 return
+        elif config['source'] == 'archive':
+            urls = archives.list()
+            logger.info(f"Replaying {len(urls)} scan archives from {config['archive_dir']}")
         elif config['url']:
             logger.debug('Scanning Single URL')
             urls = [config['url'].strip()]
             config['threads'] = 1
             config['source'] = 'url'
-        process_chunks_in_parallel(urls)
-        engine_log['total'] = success + failed + skipped
-        engine_log['success'] = success
-        engine_log['failed'] = failed
-        engine_log['skipped'] = skipped
+        pipeline.start()
+        try:
+            if config['source'] == 'archive':
+                engine_log['scheduler'] = scan_batch(urls, handler=replay)
+            else:
+                browsers.warm(config['threads'])
+                engine_log['scheduler'] = scan_batch(prefilter(urls))
+        finally:
+            browsers.close()
+            pipeline.close()
+            bodies.close()
+            seen.flush()
+            if config['save_elastic']:
+                # Documents still buffered are written before the engine log
+                entities.close()
+                writer.close()
+        if config['source'] in FEEDS:
+            feed.commit()
+        engine_log['browser'] = browsers.stats()
+        engine_log['pipeline'] = pipeline.stats()
+        engine_log['success'] = metrics.value('scans', status='success')
+        engine_log['failed'] = metrics.value('scans', status='failed')
+        engine_log['skipped'] = metrics.value('scans', status='skipped')
+        engine_log['total'] = engine_log['success'] + engine_log['failed'] + engine_log['skipped']
+        engine_log['timing'] = metrics.averages('scan_stage_seconds')
+        engine_log['domain_cache'] = hosts.stats()
+        engine_log['dns'] = dns_cache.stats()
+        engine_log['bodies'] = bodies.stats()
+        if config['save_elastic']:
+            engine_log['opensearch'] = client.stats()
+            engine_log['bulk'] = writer.stats()
+            engine_log['entities'] = entities.stats()
         engine_log['completion_utc'] = str(datetime.datetime.now(timezone.utc))[:19]
         engine_log['time'] = str(datetime.datetime.now()-start)
         # engine_log['config'] = config
@@ -417,7 +709,22 @@ def main():
             OpenSearch.raw_save('engine_log', engine_log, engine_log['engine_id'])
         print(json.dumps(engine_log, indent=4))
     else:
-        app.run(host='0.0.0.0', port=5000, debug=True)
+        browsers.warm(config['threads'])
+        pipeline.start()
+        job_scheduler.start()
+        try:
+            app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
+        finally:
+            # Jobs already accepted are scanned, and their documents written, before the engine exits
+            job_scheduler.close()
+            pipeline.join()
+            browsers.close()
+            pipeline.close()
+            bodies.close()
+            seen.flush()
+            if config['save_elastic']:
+                entities.close()
+                writer.close()
 
 
 
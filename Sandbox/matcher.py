@@ -0,0 +1,110 @@
+import re
+from functools import lru_cache
+
+# Version right after a matched name e.g. jquery-3.7.1, bootstrap@5.3.0, /vue/2.6.14/
+VERSION = re.compile(r'[-_.@/ ]v?(\d+(?:\.\d+)+)', re.IGNORECASE)
+METACHARACTERS = set('.^$*+?{}[]|()')
+ESCAPES = set('dDwWsSbBAZ')
+
+
+def required_literal(pattern):
+    """Longest run of plain characters every match of ``pattern`` must contain, lower cased, or None."""
+    if re.search(r'(?<!\\)\|', pattern):
+        return None
+    runs = [[]]
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\' and i + 1 < len(pattern):
+            i += 1
+            if pattern[i] in ESCAPES or pattern[i].isdigit() or depth:
+                runs.append([])
+            else:
+                runs[-1].append(pattern[i])
+        elif char in '()':
+            # Groups can be optional or repeated, only literals outside them are required
+            depth += 1 if char == '(' else -1
+            runs.append([])
+        elif char in '*?{':
+            # The character before is optional, so it can't be part of the literal
+            if runs[-1]:
+                runs[-1].pop()
+            runs.append([])
+            if char == '{':
+                i = pattern.find('}', i) if '}' in pattern[i:] else len(pattern)
+        elif char in METACHARACTERS:
+            if char == '[':
+                i = pattern.find(']', i + 1) if ']' in pattern[i + 1:] else len(pattern)
+            runs.append([])
+        elif depth:
+            runs.append([])
+        else:
+            runs[-1].append(char)
+        i += 1
+    literal = max((''.join(run) for run in runs), key=len)
+    return literal.lower() if literal else None
+
+
+class PatternMatcher:
+    """Matches a url against every technology pattern in one pass.
+
+    Each pattern's required literal is indexed by its first three characters, one walk over the
+    url finds the literals present and only their patterns are confirmed with a regex. Results
+    are memoized per url.
+    """
+
+    def __init__(self, patterns, cache_size=65536):
+        self.patterns = [(re.compile(entry['pattern'], re.IGNORECASE), entry['technology']) for entry in patterns]
+        self.always = []
+        self.by_literal = {}
+        for i, entry in enumerate(patterns):
+            literal = required_literal(entry['pattern'])
+            if literal:
+                self.by_literal.setdefault(literal, []).append(i)
+            else:
+                self.always.append(i)
+        self.index = {}
+        self.short = []
+        for literal in self.by_literal:
+            if len(literal) < 3:
+                self.short.append(literal)
+            else:
+                self.index.setdefault(literal[:3], []).append(literal)
+        self.match = lru_cache(maxsize=cache_size)(self._match)
+
+    def literals(self, url):
+        """Required literals present in the lower cased ``url``."""
+        found = {literal for literal in self.short if literal in url}
+        index = self.index
+        for i in range(len(url) - 2):
+            bucket = index.get(url[i:i + 3])
+            if bucket:
+                found.update(literal for literal in bucket if url.startswith(literal, i))
+        return found
+
+    def _match(self, url):
+        """All technologies matching ``url`` as (name, version) in pattern file order, version is None when not found."""
+        candidates = set(self.always)
+        for literal in self.literals(url.lower()):
+            candidates.update(self.by_literal[literal])
+        results = []
+        seen = set()
+        for i in sorted(candidates):
+            regex, technology = self.patterns[i]
+            match = regex.search(url)
+            if not match or technology in seen:
+                continue
+            seen.add(technology)
+            version = match.group('version') if 'version' in regex.groupindex else None
+            for match in ([] if version else regex.finditer(url)):
+                found = VERSION.match(url, match.end())
+                if found:
+                    version = found.group(1)
+                    break
+            results.append((technology, version))
+        return tuple(results)
+
+    def stats(self):
+        info = self.match.cache_info()
+        return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}
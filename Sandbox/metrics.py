@@ -0,0 +1,140 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = 'webamon'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class Metrics:
+    """Thread-safe counters and histograms, rendered in the Prometheus text format for /metrics.
+
+    Gauges are read from callbacks registered with ``register`` at render time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._help = {}
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def value(self, name, **labels):
+        with self._lock:
+            return self._counters.get(name, {}).get(self._key(labels), 0)
+
+    def observe(self, name, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+            histogram = series[key]
+            i = bisect.bisect_left(BUCKETS, value)
+            if i < len(BUCKETS):
+                histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def register(self, collector):
+        """``collector()`` returns a list of (name, labels, value) gauges."""
+        self._collectors.append(collector)
+
+    def averages(self, name):
+        with self._lock:
+            return {dict(key).get('stage', ''): round(h['sum'] / h['count'], 3)
+                    for key, h in self._histograms.get(name, {}).items() if h['count']}
+
+    @staticmethod
+    def _labels(key, extra=None):
+        pairs = list(key) + ([extra] if extra else [])
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def _header(self, lines, name, kind):
+        if name in self._help:
+            lines.append(f'# HELP {PREFIX}_{name} {self._help[name]}')
+        lines.append(f'# TYPE {PREFIX}_{name} {kind}')
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                self._header(lines, name, 'counter')
+                for key, value in series.items():
+                    lines.append(f'{PREFIX}_{name}_total{self._labels(key)} {value}')
+            for name, series in sorted(self._histograms.items()):
+                self._header(lines, name, 'histogram')
+                for key, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, histogram['buckets']):
+                        cumulative += count
+                        lines.append(f'{PREFIX}_{name}_bucket{self._labels(key, ("le", bound))} {cumulative}')
+                    lines.append(f'{PREFIX}_{name}_bucket{self._labels(key, ("le", "+Inf"))} {histogram["count"]}')
+                    lines.append(f'{PREFIX}_{name}_sum{self._labels(key)} {round(histogram["sum"], 6)}')
+                    lines.append(f'{PREFIX}_{name}_count{self._labels(key)} {histogram["count"]}')
+        gauges = {}
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                gauges.setdefault(name, []).append((labels, value))
+        for name, series in sorted(gauges.items()):
+            self._header(lines, name, 'gauge')
+            for labels, value in series:
+                lines.append(f'{PREFIX}_{name}{self._labels(self._key(labels))} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def observe_report(self, report):
+        """Feeds a finished report's per-stage timings into the shared histograms."""
+        self.inc('scans', status=report['scan_status'])
+        for stage, seconds in report.get('timing', {}).items():
+            if isinstance(seconds, (int, float)):
+                self.observe('scan_stage_seconds', seconds, stage=stage)
+
+
+class StageTimer:
+    """Times the stages of one scan into a report's ``timing`` dict.
+
+    Works the same in the enrichment processes, the timings travel back with the report and
+    are turned into histograms by ``Metrics.observe_report`` in the main process.
+    """
+
+    def __init__(self, timing):
+        self.timing = timing
+
+    @contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timing[name] = round(self.timing.get(name, 0.0) + time.monotonic() - start, 3)
+
+
+metrics = Metrics()
+metrics.describe('scans', 'Scans finished by status')
+metrics.describe('scan_stage_seconds', 'Seconds spent in each stage of a scan')
+metrics.describe('pipeline_wait_seconds', 'Seconds reports waited in a pipeline stage queue')
+metrics.describe('dns_queries', 'DNS record queries by cache result')
+metrics.describe('dns_lookup_seconds', 'Seconds spent on DNS queries that missed the cache')
+metrics.describe('opensearch_requests', 'OpenSearch requests by endpoint and HTTP status')
+metrics.describe('opensearch_request_seconds', 'Seconds OpenSearch requests took by endpoint')
+metrics.describe('bulk_items', 'Bulk actions by index and outcome')
+metrics.describe('bulk_flush_seconds', 'Seconds each _bulk request took')
+metrics.describe('entity_observations', 'Domain and server observations by index')
+metrics.describe('entity_writes', 'Coalesced domain and server updates written by index')
+metrics.describe('body_store_bytes', 'Bytes of response bodies held by reports in flight, in memory or spilled to disk')
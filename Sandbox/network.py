@@ -0,0 +1,111 @@
+import json
+import re
+from urllib.parse import urlparse
+
+from schema import REQUEST, RESPONSE
+
+# The method sits at the front of every performance log message, so a regex finds it
+# without decoding the whole (sometimes very large) event
+METHOD = re.compile(r'"method":\s*"([A-Za-z.]+)"')
+
+
+def as_sent(record):
+    return record
+
+
+def origin(url):
+    parsed = urlparse(url)
+    if parsed.scheme in ('http', 'https') and parsed.netloc:
+        return f'{parsed.scheme}://{parsed.netloc}'
+    return None
+
+
+class NetworkCollector:
+    """Builds request/response records from the Network events in Chrome's performance log.
+
+    Only the events we use are decoded. Records are keyed by requestId and capped at
+    ``max_requests``, anything past the cap is counted and dropped. With ``keep_log`` the
+    handled events are also kept as recorded, for scan archives. Requests and responses are
+    normalized by the schema module as the records are built, ``normalize=False`` keeps them
+    as Chrome sent them.
+    """
+
+    def __init__(self, max_requests=5000, keep_log=False, normalize=True):
+        self.max_requests = max_requests
+        self.request = REQUEST.apply if normalize else as_sent
+        self.response = RESPONSE.apply if normalize else as_sent
+        self.length = 'encoded_data_length' if normalize else 'encodedDataLength'
+        self.requests = {}
+        self.log = [] if keep_log else None
+        self.events = 0
+        self.ignored = 0
+        self.dropped = 0
+        self.handlers = {
+            'Network.requestWillBeSent': self.request_sent,
+            'Network.responseReceived': self.response_received,
+            'Network.loadingFinished': self.loading_finished,
+            'Network.loadingFailed': self.loading_failed,
+        }
+
+    def drain(self, driver):
+        self.feed(driver.get_log('performance'))
+        return self.requests
+
+    def feed(self, entries):
+        for entry in entries:
+            message = entry['message']
+            method = METHOD.search(message)
+            handler = self.handlers.get(method.group(1)) if method else None
+            if not handler:
+                self.ignored += 1
+                continue
+            self.events += 1
+            if self.log is not None:
+                self.log.append({'message': message})
+            handler(json.loads(message)['message']['params'])
+        return self.requests
+
+    def request_sent(self, params):
+        request_id = params['requestId']
+        record = self.requests.get(request_id)
+        if record and 'redirectResponse' in params:
+            # Same requestId is reused for every hop, keep the chain and carry on with the new request
+            redirect = params['redirectResponse']
+            record.setdefault('redirect', []).append({'url': record['request']['url'], 'status': redirect.get('status'),
+                                                      'location': params['request']['url']})
+            record['request'] = self.request(params['request'])
+            return
+        if not record and len(self.requests) >= self.max_requests:
+            self.dropped += 1
+            return
+        self.requests[request_id] = {'request': self.request(params['request']), 'type': params.get('type', '')}
+
+    def response_received(self, params):
+        record = self.requests.get(params['requestId'])
+        if record:
+            record['response'] = self.response(params['response'])
+
+    def loading_finished(self, params):
+        record = self.requests.get(params['requestId'])
+        if record and 'response' in record:
+            # responseReceived only knows the bytes seen so far, this is the final transfer size
+            record['response'][self.length] = params['encodedDataLength']
+
+    def loading_failed(self, params):
+        record = self.requests.get(params['requestId'])
+        if record:
+            record['failed'] = {'error_text': params.get('errorText', ''), 'canceled': params.get('canceled', False),
+                                'blocked_reason': params.get('blockedReason', '')}
+
+    def origins(self):
+        """Every http(s) origin the page sent a request to, redirect hops and frames included."""
+        found = set()
+        for record in self.requests.values():
+            found.add(origin(record['request']['url']))
+            for hop in record.get('redirect', ()):
+                found.add(origin(hop['url']))
+        found.discard(None)
+        return found
+
+    def stats(self):
+        return {'requests': len(self.requests), 'events': self.events, 'ignored': self.ignored, 'dropped': self.dropped}
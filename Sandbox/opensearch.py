@@ -1,34 +1,121 @@
 import logging
-from opensearchpy import OpenSearch, RequestsHttpConnection
 import requests
+from requests.adapters import HTTPAdapter
 import warnings
 import urllib3
+import gzip
 import json
 import base64
+import time
+import zlib
 from datetime import timezone, datetime
 from datetime import datetime
+from metrics import metrics
+from bulk import BulkWriter
+from entities import EntityCache
 warnings.filterwarnings('ignore', category=urllib3.exceptions.InsecureRequestWarning)
 
 
-class Helper:
+def gzip_stream(chunks, level=1):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class Client:
+    """One pooled, keep-alive HTTP client for every OpenSearch call the engine makes.
+
+    Connections are kept open and shared by all threads, up to ``elastic_pool_size``, a thread
+    waits for a free connection rather than opening a throwaway one. Request bodies over
+    ``elastic_compress_bytes`` (and streamed bodies) are gzipped. Every request is timed into
+    the ``opensearch_request_seconds`` histogram.
+    """
+
     def __init__(self, config):
+        self.elastic_base = config['elastic_base'].rstrip('/')
+        self.timeout = (config['elastic_connect_timeout'], config['elastic_timeout'])
+        self.compress_bytes = config['elastic_compress_bytes']
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config['elastic_pool_size'], pool_block=True)
+        self.session = requests.Session()
+        self.session.auth = tuple(json.loads(config['elastic_creds']))
+        self.session.verify = False
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def request(self, method, path, data=None, content_type='application/json'):
+        headers = {}
+        if data is not None:
+            headers['Content-Type'] = content_type
+            if isinstance(data, dict):
+                data = json.dumps(data)
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            if self.compress_bytes:
+                if not isinstance(data, bytes):
+                    data = gzip_stream(data)
+                    headers['Content-Encoding'] = 'gzip'
+                elif len(data) > self.compress_bytes:
+                    data = gzip.compress(data, compresslevel=1)
+                    headers['Content-Encoding'] = 'gzip'
+        # Index and API of the path, ids left out to keep the label set small
+        endpoint = '/'.join(path.split('/')[:2])
+        start = time.monotonic()
+        try:
+            response = self.session.request(method, f'{self.elastic_base}/{path}', data=data, headers=headers, timeout=self.timeout)
+        except requests.RequestException:
+            metrics.inc('opensearch_requests', endpoint=endpoint, status='error')
+            raise
+        finally:
+            metrics.observe('opensearch_request_seconds', time.monotonic() - start, endpoint=endpoint)
+        metrics.inc('opensearch_requests', endpoint=endpoint, status=response.status_code)
+        return response
+
+    def stats(self):
+        """Connections opened against requests sent, over every host the pool talks to."""
+        pools = self.adapter.poolmanager.pools
+        connections = requests_sent = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests_sent += pool.num_requests
+        return {'connections_opened': connections, 'requests': requests_sent,
+                'connection_reuse': round(1 - connections / requests_sent, 3) if requests_sent else 0.0}
+
+
+# Merges a new sighting into a stored resource document, the body stays as it is
+RESOURCE_SCRIPT = """
+for (field in params.union.keySet()) {
+  def values = ctx._source.get(field) instanceof List ? ctx._source.get(field) : new ArrayList();
+  if (!values.contains(params.union.get(field))) { values.add(params.union.get(field)); }
+  ctx._source.put(field, values);
+}
+ctx._source.feed = params.feed;
+ctx._source.last_update = params.last_update;
+ctx._source.last_update_utc = params.last_update_utc;
+"""
+
+
+class Helper:
+    def __init__(self, config, client=None, writer=None):
         self.config = config
+        self.client = client or Client(config)
+        self.writer = writer or BulkWriter(self.client, config)
         self.save_dom = config['save_dom']
         self.save_resources = config['save_resources']
         self.save_css = config['save_css']
         self._resources = config['resources']
         self.save_images = config['save_images']
-        self.auth = tuple(json.loads(config['elastic_creds']))
         logging.basicConfig(level=eval(f'logging.{config["log_level"]}'))
         self.logger = logging.getLogger(__name__)
         self.elastic_base = config['elastic_base']
-        _elastic_base = self.elastic_base.split('://')
-        self.protocol = _elastic_base[0]
-        self.host, self.port = tuple(_elastic_base[1].split(':'))
 
     def id_exists(self, _id, index):
         self.logger.debug(f'Checking if {_id} exists on {index}')
-        exists = requests.get(f'{self.elastic_base}/{index}/_doc/{_id}', auth=self.auth, verify=False)
+        exists = self.client.request('GET', f'{index}/_doc/{_id}')
         try:
             return exists.json()['found']
         except:
@@ -36,7 +123,7 @@ class Helper:
             return False
 
     def get_record(self, _id, index):
-        record = requests.get(f'{self.elastic_base}/{index}/_doc/{_id}', auth=self.auth, verify=False).json()
+        record = self.client.request('GET', f'{index}/_doc/{_id}').json()
         return record['_source']
 
     def raw_save(self, index, data, _id='', skip=False):
@@ -48,7 +135,7 @@ class Helper:
             path += f'/{_id}'
         else:
             path += f'/_id'
-        response = requests.post(f'{self.config["elastic_base"]}/{path}', headers={'Content-Type': 'application/json'}, auth=self.auth, data=json.dumps(data), verify=False)
+        response = self.client.request('POST', path, data)
         if response.status_code not in [200, 201]:
             self.logger.critical(f'Failed to save {index}/{_id}')
             self.logger.critical(response.text)
@@ -56,54 +143,99 @@ class Helper:
         self.logger.debug(f'Successfully saved - {index}/{_id}')
         return True
 
+    def bulk_save(self, index, data, _id=''):
+        """raw_save through the bulk writer, returns as soon as the document is queued."""
+        self.writer.index(index, data, _id)
+        self.logger.debug(f'Queued save - {index}/{_id}')
+        return True
+
     def value_exists(self, field, value, index, response):
         query = {"query": {"bool": {"must": [{"query_string": { "query": f'{field}:"{value}"'}}]}, }, "_source": [response], "size": 1}
-        response = requests.post(f'{self.elastic_base}/{index}/_search',
-                                 headers={'Content-Type': 'application/json'}, data=json.dumps(query),
-                                 auth=self.auth, verify=False).json()
+        response = self.client.request('POST', f'{index}/_search', query).json()
         if len(response['hits']['hits']) > 0:
             return response['hits']['hits'][0]['_source']['report_id']
         return False
 
+    def existing_values(self, field, values, index, response, chunk_size=100):
+        """Bulk version of value_exists, one exact ``terms`` search on ``field``.keyword per chunk,
+        collapsed to one hit per value. Returns {value: response field} for values found."""
+        found = {}
+        keyword = f'{field}.keyword'
+        values = list(values)
+        for i in range(0, len(values), chunk_size):
+            chunk = values[i:i + chunk_size]
+            query = {"query": {"terms": {keyword: chunk}}, "collapse": {"field": keyword}, "_source": [response], "size": len(chunk)}
+            result = self.client.request('POST', f'{index}/_search', query)
+            if result.status_code != 200:
+                self.logger.critical(f'Failed bulk lookup on {index}: {result.text}')
+                continue
+            for hit in result.json()['hits']['hits']:
+                found[hit['fields'][keyword][0]] = hit['_source'].get(response, True)
+        return found
+
+    def existing_ids(self, ids, index):
+        """The ids in ``ids`` that have a document in ``index``, one _mget for all of them."""
+        ids = list(ids)
+        if not ids:
+            return set()
+        response = self.client.request('POST', f'{index}/_mget', {"docs": [{"_id": _id, "_source": False} for _id in ids]})
+        if response.status_code != 200:
+            # Treated as new, creating a document that exists fails harmlessly and falls back to an update
+            self.logger.critical(f'Failed _mget on {index}: {response.text}')
+            return set()
+        return {doc['_id'] for doc in response.json()['docs'] if doc.get('found')}
+
+    def update_resource(self, sha256, resource, feed, tag):
+        """Adds this sighting's tag, ip and domain to a stored resource, the body isn't sent again."""
+        params = {"union": {"tag": tag, "ip": resource['ip'], "domains": resource['domain']}, "feed": feed,
+                  "last_update": datetime.utcnow().strftime("%Y-%m-%d"), "last_update_utc": str(datetime.now(timezone.utc))[:19]}
+        self.writer.update('resources', sha256, {"script": {"source": RESOURCE_SCRIPT, "lang": "painless", "params": params}})
+
     def format_bulk_data_resources(self, docs, feed, tag):
-        bulk_data = ""
+        """Resource documents to create, as [(sha256, document)]. The body isn't in the document,
+        ``stream_bulk_resources`` adds it from the body store while posting. Resources already
+        stored are looked up with one _mget and only get an update queued, without their body."""
+        wanted = {}
         for doc in docs:
-            exists = self.id_exists(doc, 'resources')
+            if not self.save_images and 'image' in docs[doc]['mime_type'].lower():
+                logging.debug(f"Not saving image resource {doc} - {docs[doc]['mime_type']}")
+                continue
+            if not self.save_css and 'css' in docs[doc]['mime_type'].lower():
+                logging.debug(f"Not saving CSS resource {doc} - {docs[doc]['mime_type']}")
+                continue
+            wanted[doc] = docs[doc]
+        existing = self.existing_ids(wanted, 'resources')
+        bulk_data = []
+        for doc in wanted:
             try:
-                if not self.save_images and 'image' in docs[doc]['mime_type'].lower():
-                    logging.debug(f"Not saving image resource {doc} - {docs[doc]['mime_type']}")
-                    continue
-                if not self.save_css and 'css' in docs[doc]['mime_type'].lower():
-                    logging.debug(f"Not saving CSS resource {doc} - {docs[doc]['mime_type']}")
-                    continue
-                logging.info(f"Saving Resource {doc} - {docs[doc]['mime_type']}")
-                index_metadata = json.dumps({ "index": {"_index": 'resources', "_id": doc}})
-                if not exists:
-                    doc_data = json.dumps({"last_update": datetime.utcnow().strftime("%Y-%m-%d"), "last_update_utc": str(datetime.now(timezone.utc))[:19], "first_seen_utc": datetime.utcnow().strftime("%Y-%m-%d"), "feed": feed, "tag": [tag], "resource": docs[doc]['raw_data'], "mime_type": docs[doc]['mime_type'], 'sha256': doc, "ip": [docs[doc]['ip']], "asn": [], "country": [], "domains": [docs[doc]['domain']], "notes": []})
-                    bulk_data += f"{index_metadata}\n{doc_data}\n"
+                if doc in existing:
+                    logging.debug(f"Updating Resource {doc} - {docs[doc]['mime_type']}")
+                    self.update_resource(doc, docs[doc], feed, tag)
                 else:
-                    first_seen = datetime.utcnow().strftime("%Y-%m-%d")
-                    previous = self.get_record(doc, 'resources')
-                    if 'first_seen_utc' in previous:
-                        first_seen = previous['first_seen_utc']
-                    doc_data = json.dumps({"last_update": datetime.utcnow().strftime("%Y-%m-%d"), "last_update_utc": str(datetime.now(timezone.utc))[:19], "first_seen_utc": first_seen, "feed": feed, "tag": list(set([tag] + previous['tag'])), "resource": docs[doc]['raw_data'], "mime_type": docs[doc]['mime_type'], 'sha256': doc, "ip": list(set([docs[doc]['ip']] + previous['ip'])), "asn": [], "country": [], "domains": list(set([docs[doc]['domain']] + previous['domains'])), "notes": []})
-                    bulk_data += f"{index_metadata}\n{doc_data}\n"
+                    logging.info(f"Saving Resource {doc} - {docs[doc]['mime_type']}")
+                    doc_data = {"last_update": datetime.utcnow().strftime("%Y-%m-%d"), "last_update_utc": str(datetime.now(timezone.utc))[:19], "first_seen_utc": datetime.utcnow().strftime("%Y-%m-%d"), "feed": feed, "tag": [tag], "truncated": docs[doc].get('truncated', False), "hashes": docs[doc].get('hashes', {}), "mime_type": docs[doc]['mime_type'], 'sha256': doc, "ip": [docs[doc]['ip']], "asn": [], "country": [], "domains": [docs[doc]['domain']], "notes": []}
+                    bulk_data.append((doc, doc_data))
             except Exception as e:
                 self.logger.critical(f'{e} - happened')
                 self.logger.critical(docs[doc])
 
         return bulk_data if len(bulk_data) > 0 else False
 
+    @staticmethod
+    def stream_bulk_resources(bulk_data, bodies):
+        """_bulk request body for ``format_bulk_data_resources`` documents, each resource body is
+        streamed from the body store rather than built into the request in memory. Documents are
+        created, never overwritten, so a body is only ever written once."""
+        for sha256, doc_data in bulk_data:
+            yield json.dumps({"create": {"_index": 'resources', "_id": sha256}}).encode('utf-8') + b'\n'
+            yield json.dumps(doc_data)[:-1].encode('utf-8') + b', "resource": '
+            yield from bodies.json_chunks(sha256)
+            yield b'}\n'
+
     def query(self, index, query_string, limit=2000):
-        client = OpenSearch(
-            hosts=[{'host': self.host, 'port': self.port}],
-            http_auth=self.auth,
-            use_ssl=True if self.protocol == 'https' else False,
-            verify_certs=False,
-            connection_class=RequestsHttpConnection,
-            timeout=300
-        )
-        response = client.search(index=index, body={"query": {"query_string": {"query": query_string}},"size":limit})
+        response = self.client.request('POST', f'{index}/_search', {"query": {"query_string": {"query": query_string}},"size":limit})
+        response.raise_for_status()
+        response = response.json()
         hits = response["hits"]["hits"]
         formatted_results = []
         for hit in hits:
@@ -116,38 +248,54 @@ class Helper:
             formatted_results.append(formatted_hit)
         return formatted_results
 
-    def save_report(self, report):
-        client = OpenSearch(
-            hosts=[{'host': self.host, 'port': self.port}],
-            http_auth=self.auth,
-            use_ssl=True if self.protocol == 'https' else False,
-            verify_certs=False,
-            connection_class=RequestsHttpConnection,
-            timeout=300
-        )
+    def save_report(self, report, bodies):
         resources = report.pop('resource_master', False)
         if not self.save_dom:
             self.logger.debug("NOT SAVING DOM")
             report.pop('pageDOM', False)
         self.logger.debug("SAVING REPORT TO OPENSEARCH")
-        response = client.index(index='scans', body=report, id=report['report_id'])
+        self.bulk_save('scans', report, report['report_id'])
         if self.save_resources:
             if resources:
                 self.logger.info("SAVING RESOURCES")
                 bulk_data = self.format_bulk_data_resources(resources, report['feed'], report['tag'])
                 if bulk_data:
-                    response = requests.post(f'{self.config["elastic_base"]}/_bulk', headers={"Content-Type": "application/json"}, data=bulk_data, verify=False,
-                                             auth=self.auth)
+                    response = self.client.request('POST', '_bulk', self.stream_bulk_resources(bulk_data, bodies))
                     # self.logger.debug(response.text)
-                    if response.status_code != 200 or response.json().get('errors', False):
+                    if response.status_code != 200:
                         self.logger.critical(f"Error posting bulk data: {response.text}")
                         return False
+                    if response.json().get('errors', False):
+                        errors = [item['create'] for item in response.json()['items'] if 'error' in item['create']]
+                        # Created by another scan since the _mget, this sighting is merged into it instead
+                        for item in errors:
+                            if item['error'].get('type') == 'version_conflict_engine_exception':
+                                self.update_resource(item['_id'], resources[item['_id']], report['feed'], report['tag'])
+                        errors = [item for item in errors if item['error'].get('type') != 'version_conflict_engine_exception']
+                        if errors:
+                            self.logger.critical(f"Error posting bulk data: {errors}")
+                            return False
                 else:
                     self.logger.info('No new resources to save')
         return True
 
 
-class Domains(Helper):
+class Entities(Helper):
+    """Domain and server documents, updated with one scripted upsert each so the merge with the
+    stored document happens in OpenSearch. Observations of the same entity are coalesced by
+    ``cache`` first, which is shared by Domains and Servers."""
+
+    def __init__(self, config, client=None, writer=None, cache=None):
+        super().__init__(config, client, writer)
+        self.cache = cache or EntityCache(self.writer, config)
+
+    def upsert(self, index, _id, record, union):
+        self.cache.add(index, _id, record, union)
+        self.logger.debug(f'Queued upsert - {index}/{_id}')
+        return True
+
+
+class Domains(Entities):
 
     def get_domain(self, domain):
         domain_b64 = base64.b64encode(domain.encode('utf-8')).decode('utf-8')
@@ -169,39 +317,10 @@ class Domains(Helper):
         domain_record['last_update_utc'] = str(datetime.now(timezone.utc))[:19]
         domain_record['first_seen_utc'] = str(datetime.now(timezone.utc))[:19]
         domain_record['tag'] = [self.config['tag']]
+        return self.upsert(index, domain_b64, domain_record, ['tag', 'sub_domain'])
 
-        exists = self.id_exists(domain_b64, index)
-        if not exists:
-            save = self.raw_save(index, domain_record, domain_b64)
-            return save
-
-        old_record = self.get_domain(domain)
-
-        if 'first_seen_utc' in old_record:
-            domain_record['first_seen_utc'] = old_record['first_seen_utc']
-
-        if 'tag' in old_record:
-            domain_record['tag'] = list(set([self.config['tag']] + old_record['tag']))
-
-        hashes = [record['sha256'] for record in domain_record['resource']]
-        for resource in old_record['resource']:
-            if resource['sha256'] not in hashes:
-                domain_record['resource'].append(resource)
 
-        for record in domain_record:
-            if record == "sub_domain" and record in old_record:
-                domain_record[record] = list(set(old_record[record] + domain_record[record]))
-
-            if record == 'dns' and 'dns' in old_record:
-                for dns_record in domain_record['dns']:
-                    if dns_record in old_record['dns']:
-                        if type(old_record['dns'][dns_record]) is list:
-                            domain_record['dns'][dns_record] = list(set(old_record['dns'][dns_record] + domain_record['dns'][dns_record]))
-        save = self.raw_save(index, domain_record, domain_b64)
-        return save
-
-
-class Servers(Helper):
+class Servers(Entities):
 
     def get_server(self, ip):
         ip_b64 = base64.b64encode(ip.encode('utf-8')).decode('utf-8')
@@ -219,29 +338,4 @@ class Servers(Helper):
         server_record['last_update_utc'] = str(datetime.now(timezone.utc))[:19]
         server_record['tag'] = [self.config['tag']]
         server_record['first_seen_utc'] = str(datetime.now(timezone.utc))[:19]
-
-        exists = self.id_exists(ip_b64, index)
-        if not exists:
-            save = self.raw_save(index, server_record, ip_b64)
-            return save
-
-        old_record = self.get_server(ip)
-        if 'first_seen_utc' in old_record:
-            server_record['first_seen_utc'] = old_record['first_seen_utc']
-
-        if 'tag' in old_record:
-            server_record['tag'] = list(set([self.config['tag']] + old_record['tag']))
-
-        hashes = [record['sha256'] for record in server_record['resource']]
-
-        for resource in old_record['resource']:
-            if resource['sha256'] not in hashes:
-                server_record['resource'].append(resource)
-
-        server_record['domain'] = list(set(old_record['domain'] + server_record['domain']))
-        server_record['server'] = list(set(old_record['server'] + server_record['server']))
-        save = self.raw_save(index, server_record, ip_b64)
-        return save
-
-
-
+        return self.upsert(index, ip_b64, server_record, ['tag', 'domain', 'server'])
@@ -0,0 +1,233 @@
+import datetime
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from bs4 import BeautifulSoup
+
+from report import Technology, Enrichment
+from schema import CERTIFICATE, normalize_request
+from metrics import metrics, StageTimer
+
+logger = logging.getLogger(__name__)
+
+# Set per enrichment process by init_worker
+_enrich = None
+_tech = None
+_config = None
+
+
+def init_worker(config, enrichment=Enrichment):
+    global _enrich, _tech, _config
+    logging.basicConfig(level=config['log_level'].upper())
+    _config = config
+    _enrich = enrichment()
+    _tech = Technology()
+
+
+def process_capture(network_data):
+    """CPU-bound half of a scan, runs in the enrichment process pool once the browser is released."""
+    timer = StageTimer(network_data.setdefault('timing', {}))
+    try:
+        with timer.stage('dom_parse'):
+            soup = BeautifulSoup(network_data['dom'], 'html.parser')
+            script_tags = soup.find_all('script')
+            link_tags = soup.find_all('link')
+            network_data['page_links'] = [str(x) for x in link_tags]
+            network_data['page_scripts'] = [str(x) for x in script_tags]
+        with timer.stage('technology'):
+            network_data['technology'] = _tech.getTech(script_tags, link_tags, network_data['request'])
+        _subs = []
+        certs = []
+        requestlist = []
+
+        with timer.stage('requests'):
+            bad_starts = ["blob", "data"]
+            for record in network_data['request'].values():
+                if 'response' not in record:
+                    continue
+                request_url = record['request']['url']
+                if request_url[:4] in bad_starts or record['response']['url'][:4] in bad_starts:
+                    continue
+                details = record['response'].get('security_details')
+                if details is not None:
+                    details['domain_name'], details['sub_domain'], details['tld'] = _enrich.domain_extract(request_url)
+                    if details['subjectName'] not in _subs:
+                        certificate = CERTIFICATE.apply(details)
+                        certificate['valid_from_utc'] = str(datetime.datetime.fromtimestamp(details['validFrom'], datetime.UTC))
+                        certificate['valid_to_utc'] = str(datetime.datetime.fromtimestamp(details['validTo'], datetime.UTC))
+                        certs.append(certificate)
+                        _subs.append(details['subjectName'])
+                requestlist.append(normalize_request(record))
+            network_data['certificate'] = certs
+            network_data['request'] = requestlist
+        with timer.stage('third_parties'):
+            network_data['domain'] = _enrich.thirdParties(network_data, network_data['resolved_url'])
+        with timer.stage('servers'):
+            network_data['server'] = _enrich.server_data(network_data)
+        network_data = _enrich.scanMeta(network_data)
+        network_data['scan_status'] = "success"
+    except Exception as e:
+        network_data['scan_status'] = "failed"
+        network_data['errors'].append({'error': str(e), 'url': network_data['submission_url']})
+        logger.critical(f"Enrichment failed - {network_data['submission_url']} - {e}")
+    return network_data
+
+
+class Stage:
+    """Worker threads pulling reports from a bounded queue and handing the result to the next stage."""
+
+    def __init__(self, name, func, workers, maxsize, next_stage=None, on_done=None):
+        self.name = name
+        self.func = func
+        self.workers = int(workers)
+        self.next_stage = next_stage
+        self.on_done = on_done
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._threads = []
+        self.in_flight = 0
+        self.processed = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.max_latency = 0.0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'{self.name}-stage-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, report):
+        self._queue.put((time.monotonic(), report))
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            queued, report = task
+            start = time.monotonic()
+            with self._lock:
+                self.in_flight += 1
+                self.wait_seconds += start - queued
+            metrics.observe('pipeline_wait_seconds', start - queued, stage=self.name)
+            try:
+                report = self.func(report)
+            except Exception as e:
+                logger.critical(f"{self.name} stage failed - {report['submission_url']} - {e}")
+                report['scan_status'] = 'failed'
+                report['errors'].append({'error': str(e), 'url': report['submission_url']})
+                with self._lock:
+                    self.errors += 1
+            latency = time.monotonic() - start
+            report.setdefault('timing', {})[f'{self.name}_stage'] = round(latency, 3)
+            with self._lock:
+                self.in_flight -= 1
+                self.processed += 1
+                self.busy_seconds += latency
+                self.max_latency = max(self.max_latency, latency)
+            if self.next_stage:
+                self.next_stage.put(report)
+            elif self.on_done:
+                self.on_done(report)
+
+    def stats(self):
+        with self._lock:
+            return {'depth': self._queue.qsize(), 'in_flight': self.in_flight, 'processed': self.processed, 'errors': self.errors,
+                    'avg_latency': round(self.busy_seconds / self.processed, 3) if self.processed else 0.0,
+                    'max_latency': round(self.max_latency, 3),
+                    'avg_wait': round(self.wait_seconds / self.processed, 3) if self.processed else 0.0}
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+class Pipeline:
+    """Scan stages after browser capture: enrichment in a process pool, then persistence.
+
+    Captures that failed in the browser skip enrichment and go straight to persistence.
+    """
+
+    def __init__(self, config, persist, on_done=None):
+        self.on_done = on_done
+        self.config = config
+        self.enrich_workers = config['enrich_workers']
+        self.executor = self._executor()
+        self._executor_lock = threading.Lock()
+        self.persist = Stage('persist', persist, config['persist_workers'], config['stage_queue_size'], on_done=self._finish)
+        self.enrich = Stage('enrich', self._enrich, self.enrich_workers, config['stage_queue_size'], next_stage=self.persist)
+        self._cond = threading.Condition()
+        self.outstanding = 0
+
+    def start(self):
+        self.enrich.start()
+        self.persist.start()
+        return self
+
+    def submit(self, report):
+        if report is None:
+            raise ValueError('No report to submit')
+        with self._cond:
+            self.outstanding += 1
+        if report['scan_status'] == 'captured':
+            self.enrich.put(report)
+        else:
+            self.persist.put(report)
+
+    def _executor(self):
+        # spawn rather than fork, the parent is full of threads holding locks
+        return ProcessPoolExecutor(max_workers=self.enrich_workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=init_worker, initargs=(self.config,))
+
+    def _enrich(self, report):
+        # Resource metadata and the screenshot aren't needed to build the report, keep them out of the pickle round trip
+        resources = report.pop('resource_master', {})
+        screenshot = report.pop('screenshot', None)
+        executor = self.executor
+        try:
+            report = executor.submit(process_capture, report).result()
+        except BrokenProcessPool:
+            with self._executor_lock:
+                if self.executor is executor:
+                    logger.critical('Enrichment process died, restarting the process pool')
+                    self.executor = self._executor()
+            raise
+        finally:
+            report['resource_master'] = resources
+            if screenshot is not None:
+                report['screenshot'] = screenshot
+        return report
+
+    def _finish(self, report):
+        try:
+            if self.on_done:
+                self.on_done(report)
+        except Exception as e:
+            logger.critical(f"Failed to finish {report['report_id']}: {e}")
+        finally:
+            with self._cond:
+                self.outstanding -= 1
+                self._cond.notify_all()
+
+    def join(self):
+        with self._cond:
+            while self.outstanding:
+                self._cond.wait()
+
+    def close(self):
+        self.enrich.close()
+        self.persist.close()
+        self.executor.shutdown()
+
+    def stats(self):
+        return {'outstanding': self.outstanding, 'enrich': self.enrich.stats(), 'persist': self.persist.stats()}
@@ -1,10 +1,14 @@
-from urllib.parse import urlparse
-import hashlib
-import geoip2.database
-import re
-import json
-import tldextract
-import dns.resolver
+import base64
+import logging
+from collections import deque
+from concurrent.futures import Future
+from network import NetworkCollector
+import hosts
+from hashing import Hasher, body_bytes
+from bodystore import BodyStore
+from geoip import GeoIP
+from matcher import PatternMatcher
+from grouping import group_domains, group_servers, new_domain, unique
 
 
 class Technology:
@@ -16,59 +20,134 @@ class Technology:
                 if line.strip() and not line.startswith('#'):
                     pattern, technology = line.strip().split(',', 1)
                     self.patterns.append({'pattern': pattern, 'technology': technology})
+        self.matcher = PatternMatcher(self.patterns)
 
     def get_technology_from_url(self, url):
-        for pattern in self.patterns:
-            if re.search(pattern['pattern'], url, re.IGNORECASE):
-                return pattern['technology']
-        return False
+        matches = self.matcher.match(url)
+        return matches[0][0] if matches else False
 
     def getTech(self, script_tags, link_tags, requests_in):
-        def extract_components(tags, attr):
-            return [
-                {'url': tag[attr], 'name': self.get_technology_from_url(tag[attr])}
-                for tag in tags if attr in tag.attrs and self.get_technology_from_url(tag[attr])
-            ]
-
-        script_components = extract_components(script_tags, 'src')
-        link_components = extract_components(link_tags, 'href')
-        request_components = [
-            {'url': request_data['request']['url'],
-             'name': self.get_technology_from_url(request_data['request']['url'])}
-            for request_data in requests_in.values()
-            if self.get_technology_from_url(request_data['request']['url'])
-        ]
-        tech = script_components + link_components + request_components
-        unique_tech = {comp['name']: comp for comp in tech}
+        urls = [tag['src'] for tag in script_tags if 'src' in tag.attrs]
+        urls += [tag['href'] for tag in link_tags if 'href' in tag.attrs]
+        urls += [request_data['request']['url'] for request_data in requests_in.values()]
+        unique_tech = {}
+        for url in urls:
+            for name, version in self.matcher.match(url):
+                if name in unique_tech and (unique_tech[name].get('version') or not version):
+                    continue
+                unique_tech[name] = {'url': url, 'name': name}
+                if version:
+                    unique_tech[name]['version'] = version
         return list(unique_tech.values())
 
 
 class Resources:
 
+    # Mime fragments only fetched when the matching save_* option is on
+    optional_mime = {'image': 'save_images', 'css': 'save_css', 'font': 'save_fonts', 'video': 'save_images', 'audio': 'save_images'}
+    # Bodies fetched first when the scan byte budget is tight
+    priority = ['html', 'javascript', 'ecmascript', 'json', 'xml', 'text']
+
+    @staticmethod
+    def wanted(data, config):
+        mime = data['response'].get('mime_type', '').lower()
+        for fragment, option in Resources.optional_mime.items():
+            if fragment in mime and not config.get(option, False):
+                return False
+        return 'failed' not in data
+
     @staticmethod
-    def getResources(raw, driver_session, report_id, scan_url):
+    def rank(data):
+        mime = data['response'].get('mime_type', '').lower()
+        for i, fragment in enumerate(Resources.priority):
+            if fragment in mime:
+                return i
+        return len(Resources.priority)
+
+    @staticmethod
+    def getResources(raw, driver_session, report_id, scan_url, config=None, hasher=None, store=None):
+        """Fetch response bodies through CDP, returns (mapping, resource_master, stats).
+
+        Bodies are picked by mime type before fetching and fetched one at a time within a per-body
+        (``max_body_bytes``) and per-scan (``max_scan_bytes``) budget, both counted in decoded
+        bytes: chromedriver runs one command at a time per session and Selenium drivers are not
+        thread safe, so fetching on more threads gains nothing. Bodies over the per-body budget
+        are hashed whole but stored truncated. Base64 bodies are hashed as the decoded bytes, with
+        every digest in ``hash_types``, on ``hasher``'s pool for large bodies so hashing overlaps
+        the next fetch. Bodies go into ``store`` under their sha256, resource_master only holds
+        their metadata. A driver answering with ``hashes`` (a replayed archive) hands back a body
+        already truncated, those hashes of the whole body are kept.
+        """
+        config = config or {}
+        hasher = hasher or Hasher(config)
+        store = store if store is not None else BodyStore()
+        max_body = config.get('max_body_bytes', 0)
+        max_scan = config.get('max_scan_bytes', 0)
+        stats = {'fetched': 0, 'skipped': 0, 'truncated': 0, 'failed': 0, 'over_budget': 0, 'bytes': 0}
         mapping = []
         resource_master = {}
+        fetched = deque()
+
+        eligible = []
         for request_id, data in raw.items():
-            if 'response' in data:
-                try:
-                    response_body = driver_session.execute_cdp_cmd('Network.getResponseBody', {'requestId': request_id})
-                    if 'body' in response_body:
-                        _sha256_hash = hashlib.sha256()
-                        _sha256_hash.update(response_body['body'].encode('utf-8'))
-                        sha256 = _sha256_hash.hexdigest()
-                        mapping.append({'sha256': sha256, 'url': data['request']['url'], "mime_type": data['response']['mimeType']})
-                        resource_master[sha256] = {"report_id": report_id, "raw_data": response_body['body'],
-                                                   "sha256": sha256, "mime_type": data['response']['mimeType'],
-                                                   "request_id": request_id, "submission_url": scan_url,
-                                                   "resource_url": data['response']['url'], "ip": data['response']['remoteIPAddress'], 'domain': tldextract.extract(data['response']['url']).registered_domain}
-                except:
-                    pass
-        return mapping, resource_master
+            if 'response' not in data:
+                continue
+            if not Resources.wanted(data, config):
+                stats['skipped'] += 1
+                continue
+            eligible.append((request_id, data))
+        eligible.sort(key=lambda item: Resources.rank(item[1]))
+
+        for request_id, data in eligible:
+            expected = int(data['response'].get('encoded_data_length') or 0)
+            if max_scan and stats['bytes'] + expected > max_scan:
+                stats['over_budget'] += 1
+                continue
+            try:
+                response_body = driver_session.execute_cdp_cmd('Network.getResponseBody', {'requestId': request_id})
+            except Exception as e:
+                logging.debug(f"Failed to fetch body {data['response']['url']} - {e}")
+                stats['failed'] += 1
+                continue
+            if 'body' not in response_body:
+                continue
+            body = response_body['body']
+            encoded = response_body.get('base64Encoded', False)
+            content = body_bytes(body, encoded)
+            recorded = response_body.get('hashes')
+            if recorded:
+                digests = Future()
+                digests.set_result(recorded)
+            else:
+                digests = hasher.submit(content)
+            truncated = bool(recorded) or (bool(max_body) and len(content) > max_body)
+            if max_body and len(content) > max_body:
+                body = base64.b64encode(content[:max_body]).decode('ascii') if encoded else content[:max_body].decode('utf-8', errors='ignore')
+            stats['fetched'] += 1
+            stats['bytes'] += len(content)
+            fetched.append((request_id, data, body, encoded, truncated, digests))
+
+        while fetched:
+            # Popped so each body is only referenced by the store once it is stored
+            request_id, data, body, encoded, truncated, digests = fetched.popleft()
+            hashes = digests.result()
+            sha256 = hashes['sha256']
+            if truncated:
+                stats['truncated'] += 1
+            mapping.append({'sha256': sha256, 'url': data['request']['url'], "mime_type": data['response']['mime_type'], 'hashes': hashes})
+            if sha256 not in resource_master:
+                store.put(sha256, body)
+            resource_master[sha256] = {"report_id": report_id,
+                                       "sha256": sha256, "hashes": hashes, "mime_type": data['response']['mime_type'],
+                                       "request_id": request_id, "submission_url": scan_url, "truncated": truncated, "base64_encoded": encoded,
+                                       "resource_url": data['response']['url'], "ip": data['response'].get('ip', ''), 'domain': hosts.registered_domain(data['response']['url'])}
+        return mapping, resource_master, stats
 
 
 class Formatting:
 
+    # clean_data and transform_headers are superseded in the pipeline by the schema module,
+    # benchmark.py keeps using them as the reference the normalizer is measured against
     @staticmethod
     def clean_data(report):
         if 'request' in report:
@@ -161,88 +240,17 @@ class Formatting:
 class Enrichment:
 
     def __init__(self):
-        self.ip_asn = geoip2.database.Reader(r'geoIP/GeoLite2-ASN.mmdb')
-        self.ip_country = geoip2.database.Reader(r'geoIP/GeoLite2-Country.mmdb')
-        self.country_cache = {}
-        self.asn_cache = {}
-
-    def domain_info(self, domain, raw):
-        master = {'hosting_scripts': False,
-                  'mime_type': [],
-                  'whois': {},
-                  'resource': [],
-                  'ip': '',
-                  'response_code': [],
-                  'request': [],
-                  'sub_domain': [],
-                  'total_response_size': 0.0,
-                  'server': '',
-                  'root': False}
-
-        for request in raw['request']:
-            _domain, sub, tld = self.domain_extract(request['response']['url'])
-            if _domain == domain:
-
-                url = request['response'].get('url', '')
-                mime_type = request['response'].get('mimeType', '')
-                ip = request['response'].get('remoteIPAddress', '')
-                response_code = request['response'].get('status', '')
-                size = request['response'].get('encodedDataLength', '')
-
-                master['request'].append(
-                    {'url': url, "mime_type": mime_type,
-                     'ip': ip, 'response_code': response_code,
-                     'encoded_data_length': size})
-
-                if not master['ip'] and request['response'].get('remoteIPAddress'):
-                    master['ip'] = request['response']['remoteIPAddress']
-
-                master['total_response_size'] += float(request['response']['encodedDataLength'])
-                master['name'] = _domain
-                master['sub_domain'].append(sub)
-                master['tld'] = tld
-                master['response_code'].append(request['response']['status'])
-                master['mime_type'].append(request['response']['mimeType'])
+        self.geoip = GeoIP(r'geoIP/GeoLite2-ASN.mmdb', r'geoIP/GeoLite2-Country.mmdb')
 
+    def domain_info(self, domain, groups, geo):
+        """Domain document for ``domain`` from the groups built by ``group_domains``, with the GeoIP
+        answer for its IP taken from ``geo``.
 
-                for header in request['response']['headers']:
-                    if header['name'].lower() == 'server':
-                        master['server'] = header['value']
-
-                for resource in raw['resource']:
-                    resource_domain, sub, tld = self.domain_extract(resource['url'])
-                    if resource_domain == _domain:
-                        master['resource'].append(resource)
-
-                for certificate in raw['certificate']:
-                    if certificate['domain_name'] == master['name']:
-                        master['certificate'] = certificate
-
-        master['response_code'] = list(set(master['response_code']))
-        master['mime_type'] = list(set(master['mime_type']))
-        master['sub_domain'] = list(set(master['sub_domain']))
-        master['request_count'] = len(master['request'])
-        master['dns'] = self.get_dns_info(domain)
-
-        if master['ip'] and (master['ip'] in self.country_cache and master['ip'] in self.asn_cache):
-            master['country'] = self.country_cache[master['ip']]
-            master['asn'] = self.asn_cache[master['ip']]
-        elif master['ip']:
-            master['country'] = self.ip2country(master['ip'])
-            master['asn'] = self.ip2asn(master['ip'])
-
-        for mime in master['mime_type']:
-            if 'script' in mime:
-                master['hosting_scripts'] = True
-                break
-
-        resource_clean = {}
-        for resource in master['resource']:
-            if resource['sha256'] not in resource_clean:
-                resource_clean[resource['sha256']] = resource
-
-        master['resource'] = [resource_clean[resource] for resource in resource_clean]
-
+        DNS records are added later by ``DNSCache`` in the main process, where the cache is shared.
+        """
+        master = groups.get(domain) or dict(new_domain(), name=domain, request_count=0)
+        if master['ip']:
+            master['country'], master['asn'] = geo[master['ip']]
         return master
 
     @staticmethod
@@ -260,140 +268,29 @@ class Enrichment:
         report['meta'] = meta
         return report
 
-    def thirdParties(self,raw, resolved_url):
-        root_domain = tldextract.extract(resolved_url).registered_domain
-        domains = list({self.domain_extract(request['request']['url'])[0] for request in raw['request']})
-        if len(domains) == 0:
-            domains = list(self.domain_extract(raw['request']['request']['url'])[0])
+    def thirdParties(self, raw, resolved_url):
+        root_domain = hosts.registered_domain(resolved_url)
+        groups = group_domains(raw, self.domain_extract)
+        domains = unique(self.domain_extract(request['request']['url'])[0] for request in raw['request'])
+        geo = self.geoip.lookup_many(group['ip'] for group in groups.values())
         master = []
         for domain in domains:
-            analysis = self.domain_info(domain, raw)
+            analysis = self.domain_info(domain, groups, geo)
             analysis['root'] = (domain == root_domain)
             master.append(analysis)
         return master
 
-    def ip2country(self, ip):
-        result = self.ip_country.country(ip)
-        country = {"name": result.country.name, "iso": result.country.iso_code}
-        self.country_cache[ip] = country
-        return country
-
-    def ip2asn(self, ip):
-        result = self.ip_asn.asn(ip)
-        asn = {"number": result.autonomous_system_number, "name": result.autonomous_system_organization,
-               "network": str(result.network)}
-        self.asn_cache[ip] = asn
-        return asn
-
-    @staticmethod
-    def get_dns_info(domain):
-        dns_info = {}
-        record_types = ['A', 'AAAA', 'MX', 'NS', 'TXT', 'CNAME', 'SOA', 'PTR']
-        try:
-            for record_type in record_types:
-                try:
-                    answers = dns.resolver.resolve(domain, record_type)
-                    dns_info[record_type.lower()] = [str(answer) for answer in answers]
-                except dns.resolver.NoAnswer:
-                    dns_info[record_type.lower()] = []
-                except dns.resolver.NXDOMAIN:
-                    return {"error": "Domain does not exist"}
-                except Exception as e:
-                    dns_info[record_type] = f"Error retrieving {record_type} records: {e}"
-        except Exception as e:
-            return {"error": f"Error retrieving DNS info: {e}"}
-        return dns_info
-
     @staticmethod
     def domain_extract(url):
-        dirty = urlparse(url).netloc
-        clean = tldextract.extract(dirty)
-        return clean.registered_domain, clean.subdomain, clean.suffix
+        return hosts.domain_extract(url)
 
     @staticmethod
     def response_data(logs, network_data):
-        for entry in logs:
-            log = json.loads(entry['message'])['message']
-            if log['method'] == 'Network.requestWillBeSent':
-                network_data['request'][log['params']['requestId']] = {
-                    'request': log['params']['request'],
-                }
-            if log['method'] == 'Network.responseReceived':
-                request_id = log['params']['requestId']
-                if request_id in network_data['request']:
-                    network_data['request'][request_id]['response'] = log['params']['response']
+        collector = NetworkCollector()
+        collector.requests = network_data['request']
+        collector.feed(logs)
         return network_data
 
     @staticmethod
     def server_data(report):
-        results = {}
-        for domain in report['domain']:
-            ip = domain['ip']
-            master = {
-                'hosting_scripts': False,
-                'mime_type': [],
-                'ip': '',
-                'country': None,
-                'asn': None,
-                'resource': [],
-                'response_code': [],
-                'domain': [],
-                'total_response_size': 0.0,
-                'server': [],
-            }
-
-            if ip not in results:
-                master['ip'] = ip
-                master['hosting_scripts'] = domain['hosting_scripts']
-                master['response_code'] = domain['response_code']
-                master['mime_type'] = domain['mime_type']
-                master['resource'] = domain['resource']
-                if 'country' in domain:
-                    master['country'] = domain['country']
-
-                if 'asn' in domain:
-                    master['asn'] = domain['asn']
-                master['domain'].append(domain['name'])
-                master['total_response_size'] = domain['total_response_size']
-                if domain['server']:
-                    master['server'].append(domain['server'])
-                results[ip] = master
-            else:
-                results[ip]['ip'] = ip
-                results[ip]['domain'].append(domain['name'])
-
-                if domain['hosting_scripts'] and not results[ip]['hosting_scripts']:
-                    results[ip]['hosting_scripts'] = True
-
-
-                if domain['name'] not in results[ip]['domain']:
-                    results[ip]['domain'].append(domain['name'])
-
-                if domain['server']:
-                    results[ip]['server'].append(domain['server'])
-
-                for mime in domain['mime_type']:
-                    results[ip]['mime_type'].append(mime)
-
-                for resource in domain['resource']:
-                    results[ip]['resource'].append(resource)
-
-                for response_code in domain['response_code']:
-                    results[ip]['response_code'].append(response_code)
-
-                results[ip]['total_response_size'] += float(domain['total_response_size'])
-
-        for server in results:
-
-            resource_clean = {}
-            for resource in results[server]['resource']:
-                if resource['sha256'] not in resource_clean:
-                    resource_clean[resource['sha256']] = resource
-
-            results[server]['resource'] = [resource_clean[resource] for resource in resource_clean]
-            results[server]['response_code'] = list(set(results[server]['response_code']))
-            results[server]['server'] = list(set(results[server]['server']))
-            results[server]['mime_type'] = list(set(results[server]['mime_type']))
-            results[server]['domain'] = list(set(results[server]['domain']))
-
-        return [results[result] for result in results]
+        return group_servers(report['domain'])
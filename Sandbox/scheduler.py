@@ -0,0 +1,151 @@
+import datetime
+import logging
+import queue
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """Shared work queue that worker threads pull from one item at a time.
+
+    ``handler(item)`` does the work, ``retry_if(result)`` decides whether a result was a
+    transient failure worth another attempt, ``on_retry(item, result)`` is handed the result
+    thrown away for it and ``on_done(item, result)`` receives the final result of every item. Submitting blocks once ``max_pending`` items are waiting.
+    """
+
+    def __init__(self, handler, workers, on_done=None, retry_if=None, on_retry=None, retries=2, backoff=5.0, max_pending=0, progress_interval=30, name='scan'):
+        self.handler = handler
+        self.workers = int(workers)
+        self.on_done = on_done
+        self.retry_if = retry_if
+        self.on_retry = on_retry
+        self.retries = retries
+        self.backoff = backoff
+        self.progress_interval = progress_interval
+        self.name = name
+        self._queue = queue.Queue(maxsize=max_pending or self.workers * 2)
+        self._cond = threading.Condition()
+        self._threads = []
+        self._closed = threading.Event()
+        self.total = 0
+        self.done = 0
+        self.retried = 0
+        self.in_flight = 0
+        self.outstanding = 0
+        self.started = None
+
+    def start(self):
+        self.started = time.monotonic()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'{self.name}-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self.progress_interval:
+            threading.Thread(target=self._report, name=f'{self.name}-progress', daemon=True).start()
+        return self
+
+    def submit(self, item, block=True):
+        with self._cond:
+            self.total += 1
+            self.outstanding += 1
+        try:
+            self._queue.put((item, 0), block=block)
+        except queue.Full:
+            with self._cond:
+                self.total -= 1
+                self.outstanding -= 1
+            raise
+
+    def join(self):
+        with self._cond:
+            while self.outstanding:
+                self._cond.wait()
+
+    def close(self):
+        self._closed.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def run(self, items):
+        self.start()
+        try:
+            for item in items:
+                self.submit(item)
+            self.join()
+        finally:
+            self.close()
+        logger.info(self.summary())
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            item, attempt = task
+            with self._cond:
+                self.in_flight += 1
+            try:
+                result = self.handler(item)
+                transient = bool(self.retry_if and self.retry_if(result))
+            except Exception as e:
+                logger.critical(f'{self.name} worker error on {item}: {e}')
+                result = None
+                transient = True
+            with self._cond:
+                self.in_flight -= 1
+            if transient and attempt < self.retries:
+                if self.on_retry:
+                    try:
+                        self.on_retry(item, result)
+                    except Exception as e:
+                        logger.critical(f'{self.name} failed to discard {item}: {e}')
+                self._retry(item, attempt + 1)
+                continue
+            self._finish(item, result)
+
+    def _retry(self, item, attempt):
+        delay = self.backoff * 2 ** (attempt - 1) * random.uniform(0.8, 1.2)
+        with self._cond:
+            self.retried += 1
+        logger.info(f'Retrying {item} in {delay:.1f}s (attempt {attempt + 1}/{self.retries + 1})')
+        timer = threading.Timer(delay, self._queue.put, args=((item, attempt),))
+        timer.daemon = True
+        timer.start()
+
+    def _finish(self, item, result):
+        try:
+            if self.on_done:
+                self.on_done(item, result)
+        except Exception as e:
+            logger.critical(f'{self.name} failed to finish {item}: {e}')
+        finally:
+            with self._cond:
+                self.done += 1
+                self.outstanding -= 1
+                self._cond.notify_all()
+
+    def progress(self):
+        with self._cond:
+            elapsed = time.monotonic() - self.started if self.started else 0.0
+            rate = self.done / elapsed if elapsed else 0.0
+            remaining = self.outstanding
+            return {'total': self.total, 'done': self.done, 'in_flight': self.in_flight, 'queued': self._queue.qsize(),
+                    'retried': self.retried, 'rate_per_min': round(rate * 60, 2), 'elapsed': round(elapsed, 1),
+                    'eta': round(remaining / rate, 1) if rate else None}
+
+    def summary(self):
+        progress = self.progress()
+        percent = f"{progress['done'] / progress['total']:.0%}" if progress['total'] else '0%'
+        eta = str(datetime.timedelta(seconds=int(progress['eta']))) if progress['eta'] is not None else 'unknown'
+        return (f"{self.name} progress {progress['done']}/{progress['total']} ({percent}) - {progress['rate_per_min']} per min - "
+                f"in flight {progress['in_flight']} - queued {progress['queued']} - retries {progress['retried']} - ETA {eta}")
+
+    def _report(self):
+        while not self._closed.wait(self.progress_interval):
+            logger.info(self.summary())
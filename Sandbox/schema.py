@@ -0,0 +1,68 @@
+def pairs(value):
+    """A dict as a list of name/value pairs, the shape OpenSearch indexes without a field per key."""
+    return [{"name": str(item), "value": str(value[item])} for item in value]
+
+
+class Schema:
+    """Field mapping for one kind of record: keys dropped, keys renamed, and dict fields reshaped
+    into lists of name/value pairs. ``apply`` builds the normalized record in one pass over its keys.
+    """
+
+    def __init__(self, drop=(), rename=None, pairs=()):
+        rename = rename or {}
+        # One lookup per key: None drops it, otherwise the output name
+        self.names = {key: None for key in drop}
+        self.names.update(rename)
+        self.pairs = frozenset(pairs)
+
+    def apply(self, record):
+        names = self.names
+        paired = self.pairs
+        normalized = {}
+        for key, value in record.items():
+            name = names.get(key, key)
+            if name is None:
+                continue
+            if key in paired and value.__class__ is dict:
+                value = pairs(value)
+            normalized[name] = value
+        return normalized
+
+
+REQUEST = Schema(drop=['initialPriority', 'isLinkPreload', 'isSameSite', 'mixedContentType'],
+                 rename={"hasPostData": "has_post_data", "postData": "post_data", "postDataEntries": "post_data_entry",
+                         "referrerPolicy": "referrer_policy"},
+                 pairs=['headers'])
+
+RESPONSE = Schema(drop=['timing', 'alternateProtocolUsage', 'charset', 'connectionId', 'connectionReused', 'fromDiskCache',
+                        'fromPrefetchCache', 'fromServiceWorker'],
+                  rename={"encodedDataLength": 'encoded_data_length', "mimeType": "mime_type", "remoteIPAddress": "ip",
+                          "remotePort": "port", "responseTime": "response_time", "securityDetails": "security_details",
+                          "securityState": "security_state", "statusText": "status_text"},
+                  pairs=['headers'])
+
+CERTIFICATE = Schema(drop=['certificateId', 'certificateTransparencyCompliance', 'encryptedClientHello'],
+                     rename={"keyExchange": "key_exchange", "keyExchangeGroup": "key_exchange_group", "sanList": "san_list",
+                             "serverSignatureAlgorithm": "signature_algorithm", "subjectName": "subject_name",
+                             "validFrom": "valid_from", "validTo": "valid_to"})
+
+COOKIE = Schema(rename={"httpOnly": "http_only", "sameSite": "same_site"})
+
+
+def normalize_request(record):
+    """Finishes a NetworkCollector record, whose request and response are normalized as they are
+    collected: security_details stays a dict until enrichment has read the certificate from it."""
+    details = record.get('response', {}).get('security_details')
+    if details.__class__ is dict:
+        record['response']['security_details'] = pairs(details)
+    return record
+
+
+def normalize_report(report):
+    """Normalizes the parts of a report ``process_capture`` leaves alone: cookies, and the raw
+    request records of reports that failed before enrichment."""
+    if isinstance(report.get('request'), dict):
+        report['request'] = [normalize_request(record) for record in report['request'].values()]
+    if 'cookie' in report:
+        report['cookie'] = [COOKIE.apply(cookie) for cookie in report['cookie']]
+    return report
@@ -0,0 +1,75 @@
+import base64
+import io
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Chrome refuses to capture textures taller than this
+MAX_HEIGHT = 16384
+
+
+def make_thumbnail(screenshot_base64, size, quality):
+    start = time.monotonic()
+    image = Image.open(io.BytesIO(base64.b64decode(screenshot_base64)))
+    image.thumbnail(size, Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    image.convert('RGB').save(buffer, format="JPEG", quality=quality)
+    return base64.b64encode(buffer.getvalue()).decode('utf-8'), time.monotonic() - start
+
+
+class Screenshot:
+    """Asks Chrome for an already compressed JPEG with ``Page.captureScreenshot``.
+
+    Thumbnails are resized on a background encoder pool so the browser is released
+    as soon as the capture returns.
+    """
+
+    def __init__(self, config):
+        self.full_page = config['screenshot_mode'] == 'full'
+        self.quality = int(config['screenshot_quality'])
+        self.scale = float(config['screenshot_scale'])
+        self.thumbnail_size = tuple(int(x) for x in config['screenshot_thumbnail'].lower().split('x')) if config['screenshot_thumbnail'] else None
+        self.encoder = ThreadPoolExecutor(max_workers=int(config['screenshot_encoders']), thread_name_prefix='screenshot')
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def clip(self, driver):
+        metrics = driver.execute_cdp_cmd('Page.getLayoutMetrics', {})
+        if self.full_page:
+            content = metrics['cssContentSize']
+            return {'x': 0, 'y': 0, 'width': content['width'], 'height': min(content['height'], MAX_HEIGHT / self.scale), 'scale': self.scale}
+        viewport = metrics['cssVisualViewport']
+        return {'x': viewport['pageX'], 'y': viewport['pageY'], 'width': viewport['clientWidth'], 'height': viewport['clientHeight'], 'scale': self.scale}
+
+    def capture(self, driver, report_id):
+        """Returns the screenshot as a base64 JPEG."""
+        params = {'format': 'jpeg', 'quality': self.quality, 'clip': self.clip(driver), 'captureBeyondViewport': self.full_page}
+        data = driver.execute_cdp_cmd('Page.captureScreenshot', params)['data']
+        if self.thumbnail_size:
+            with self._lock:
+                self._pending[report_id] = self.encoder.submit(make_thumbnail, data, self.thumbnail_size, self.quality)
+        return data
+
+    def thumbnail(self, report_id):
+        """Waits for the thumbnail queued by ``capture``, returns (thumbnail, seconds) or (False, 0.0)."""
+        with self._lock:
+            future = self._pending.pop(report_id, None)
+        if not future:
+            return False, 0.0
+        try:
+            return future.result()
+        except Exception as e:
+            logger.critical(f'Failed to encode thumbnail for {report_id}: {e}')
+            return False, 0.0
+
+    def discard(self, report_id):
+        """Drops the thumbnail queued for a capture nothing will persist."""
+        with self._lock:
+            future = self._pending.pop(report_id, None)
+        if future:
+            future.cancel()
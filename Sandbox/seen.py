@@ -0,0 +1,80 @@
+import bisect
+import hashlib
+import logging
+import os
+import threading
+from array import array
+from urllib.parse import urlsplit, urlunsplit
+
+logger = logging.getLogger(__name__)
+
+
+def with_scheme(url):
+    url = url.strip()
+    return url if url.lower().startswith(('https://', 'http://')) else f'https://{url}'
+
+
+def normalize_url(url):
+    """Form used to compare urls: scheme added, scheme/host lower cased, fragment and default ports dropped."""
+    parts = urlsplit(with_scheme(url))
+    netloc = parts.netloc.lower()
+    if (parts.scheme == 'https' and netloc.endswith(':443')) or (parts.scheme == 'http' and netloc.endswith(':80')):
+        netloc = netloc.rsplit(':', 1)[0]
+    return urlunsplit((parts.scheme.lower(), netloc, parts.path or '/', parts.query, ''))
+
+
+class SeenSet:
+    """Urls already scanned, kept on disk as a sorted file of 8 byte url hashes.
+
+    Lookups bisect the sorted keys, new urls sit in a set until ``flush`` merges them
+    into the file.
+    """
+
+    flush_every = 10000
+
+    def __init__(self, path):
+        self.path = path
+        self._keys = array('Q')
+        self._new = set()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, 'rb') as file:
+                self._keys.frombytes(file.read())
+            logger.info(f'Loaded {len(self._keys)} seen urls from {path}')
+
+    @staticmethod
+    def key(url):
+        return int.from_bytes(hashlib.blake2b(normalize_url(url).encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def __contains__(self, url):
+        key = self.key(url)
+        with self._lock:
+            if key in self._new:
+                return True
+            i = bisect.bisect_left(self._keys, key)
+            return i < len(self._keys) and self._keys[i] == key
+
+    def __len__(self):
+        return len(self._keys) + len(self._new)
+
+    def add(self, url):
+        key = self.key(url)
+        with self._lock:
+            self._new.add(key)
+            pending = len(self._new)
+        if pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._new:
+                return
+            self._keys = array('Q', sorted(set(self._keys).union(self._new)))
+            self._new = set()
+            if not self.path:
+                return
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'wb') as file:
+                self._keys.tofile(file)
+            os.replace(tmp, self.path)
+        logger.debug(f'Saved {len(self._keys)} seen urls to {self.path}')
@@ -20,7 +20,11 @@ def remove_images(resources):
     return resources
 
 
-def analyze(report, endpoint):
+def with_bodies(resources, bodies):
+    return {sha256: dict(resource, raw_data=bodies.get(sha256)) for sha256, resource in resources.items()}
+
+
+def analyze(report, endpoint, bodies):
     report_parts = {
         "ai_resources": report.pop('resource_master', False),
         "ai_dom": report.pop('dom', False),
@@ -35,7 +39,7 @@ def analyze(report, endpoint):
             if not part == 'ai_resources':
                 raw = report_parts[part]
             else:
-                raw = remove_images(report_parts[part])
+                raw = with_bodies(remove_images(report_parts[part]), bodies)
             print(endpoint)
             response = requests.post(endpoint, json={"message": f"""{prompt}\n\n{raw}"""})
             print(response.text)